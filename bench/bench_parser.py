@@ -0,0 +1,106 @@
+"""Микробенчмарк разбора выписок на 10 000 строк.
+
+Сначала сверяет parse_amount с таблицей поддерживаемых форматов сумм, затем
+сравнивает прежний разбор (float, компиляция шаблона на каждый вызов) с
+statement_parser и показывает расхождение итоговой суммы в копейках.
+
+    python bench/bench_parser.py [строк] [повторов]
+"""
+import os
+import re
+import sys
+import random
+import timeit
+from decimal import Decimal
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from statement_parser import parse_amount, parse_statement  # noqa: E402
+
+# Запись суммы → ожидаемый Decimal (None — не число или неоднозначно)
+AMOUNT_FORMATS = [
+    ("1234,56", Decimal("1234.56")),
+    ("1234.56", Decimal("1234.56")),
+    ("1 234 567,89", Decimal("1234567.89")),
+    ("1\xa0234\xa0567,89", Decimal("1234567.89")),
+    ("1\u202f234,5", Decimal("1234.5")),
+    ("1.234.567,89", Decimal("1234567.89")),
+    ("1,234,567.89", Decimal("1234567.89")),
+    ("1.234.567", Decimal("1234567")),
+    ("1,234,567", Decimal("1234567")),
+    ("-1 234,56", Decimal("-1234.56")),
+    ("1 234,56-", Decimal("-1234.56")),
+    ("\u22125,00", Decimal("-5.00")),
+    ("1 234,56 ₽", Decimal("1234.56")),
+    ("1 234 руб", Decimal("1234")),
+    ("1.234.56", None),
+    ("1.23.456", None),
+    ("12.34,56", None),
+    ("1,234.567.89", None),
+    ("abc", None),
+]
+
+
+def check_formats():
+    """True, если parse_amount и parse_statement (быстрый путь в шаблоне строки)
+    разбирают все записи из AMOUNT_FORMATS как ожидается"""
+    ok = True
+    for raw, expected in AMOUNT_FORMATS:
+        got = parse_amount(raw)
+        if got != expected:
+            ok = False
+            print(f"parse_amount({raw!r}) = {got}, ожидалось {expected}")
+        entries, _ = parse_statement(f"^Счёт${raw}$")
+        got = entries[0][1] if entries else None
+        if got != expected:
+            ok = False
+            print(f"parse_statement(^Счёт${raw}$) = {got}, ожидалось {expected}")
+    return ok
+
+
+def legacy_parse(text):
+    parsed = []
+    total = 0.0
+    pattern = re.compile(r"^\^(.+?)\$(\-?[\d\s.,]+)\$", re.MULTILINE)
+    for match in pattern.finditer(text):
+        name = match.group(1).strip()
+        value = float(match.group(2).replace("\xa0", "").replace(" ", "").replace(",", "."))
+        parsed.append((name, value))
+        total += value
+    parsed.sort(key=lambda x: x[1], reverse=True)
+    return parsed, total
+
+
+def make_message(lines, seed=1):
+    rnd = random.Random(seed)
+    out = ["Остатки на счетах"]
+    for i in range(lines):
+        rub = rnd.randint(0, 50_000_000)
+        kop = rnd.randint(0, 99)
+        amount = f"{rub:,}".replace(",", "\xa0") + f",{kop:02d}"
+        if rnd.random() < 0.05:
+            amount = "-" + amount
+        out.append(f"^Счёт {i:05d} ООО «Ромашка»${amount}$")
+    return "\n".join(out)
+
+
+def main():
+    lines = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    if not check_formats():
+        sys.exit(1)
+    print(f"форматы сумм: {len(AMOUNT_FORMATS)} из {len(AMOUNT_FORMATS)} разобраны верно")
+    text = make_message(lines)
+
+    for name, func in (("legacy", legacy_parse), ("statement_parser", parse_statement)):
+        best = min(timeit.repeat(lambda: func(text), number=1, repeat=repeat))
+        print(f"{name:>17}: {best * 1000:8.2f} мс  {lines / best:12,.0f} строк/с")
+
+    _, legacy_total = legacy_parse(text)
+    _, total = parse_statement(text)
+    print(f"{'итог float':>17}: {legacy_total:,.6f}")
+    print(f"{'итог Decimal':>17}: {total:,}")
+
+
+if __name__ == "__main__":
+    main()
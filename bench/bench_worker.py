@@ -0,0 +1,178 @@
+"""Нагрузочный бенчмарк обработчиков worker.py без боевых учётных данных.
+
+Bot API заменён локальным aiohttp-сервером (bench/fakes.py), MySQL — SQLite со
+схемой касс и пошлин, сообщения Telethon — синтетическими событиями. Обработчики
+воркера вызываются как есть: handler() и process_statements() для выписок и Dispatcher.feed_update()
+для нажатий кнопок (с разбором callback_data, middleware и ответами в Bot API).
+
+Сценарии: приём выписок, рассылка сводки по нескольким чатам и каждое
+представление под параллельной нагрузкой. Для каждого печатаются p50/p99/max
+и пропускная способность.
+
+    python bench/bench_worker.py [--requests 200] [--concurrency 20] [--chats 20]
+                                 [--api-latency-ms 30] [--db-latency-ms 5] [--rate-limits]
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+TMP = tempfile.mkdtemp(prefix="bench-worker-")
+
+# Безопасные значения настроек: боевые ключи не нужны, Telethon в роли bot не создаётся
+os.environ.update({
+    "BOT_TOKEN": "123456:BENCHBENCHBENCHBENCHBENCHBENCHBENCH",
+    "OWNER_CHAT_ID": "100",
+    "ALLOWED_START_IDS": "100",
+    "SUMMARY_CHAT_IDS": "",
+    "SNAPSHOT_DB_PATH": os.path.join(TMP, "snapshots.sqlite3"),
+    "METRICS_PORT": "",
+})
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from aiogram import Bot  # noqa: E402
+from aiogram.client.default import DefaultBotProperties  # noqa: E402
+from aiogram.client.session.aiohttp import AiohttpSession  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+from aiogram.enums import ParseMode  # noqa: E402
+from aiogram.types import Update  # noqa: E402
+
+import db  # noqa: E402
+import logs  # noqa: E402
+import delivery  # noqa: E402
+import callbacks  # noqa: E402
+import worker  # noqa: E402
+from fakes import FakeBotAPI, SQLitePool, create_database, statement_event, callback_update  # noqa: E402
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(q * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def report(name, latencies, wall):
+    values = sorted(latencies)
+    print(
+        f"{name:<28} n={len(values):<5} "
+        f"p50={percentile(values, 0.50) * 1000:8.2f} мс  "
+        f"p99={percentile(values, 0.99) * 1000:8.2f} мс  "
+        f"max={values[-1] * 1000 if values else 0:8.2f} мс  "
+        f"{len(values) / wall if wall else 0:9.1f} оп/с"
+    )
+
+
+async def run_load(name, factories, concurrency):
+    """Выполняет корутины из factories не более чем по concurrency одновременно"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(factory):
+        async with semaphore:
+            start = time.perf_counter()
+            await factory()
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(f) for f in factories))
+    report(name, latencies, time.perf_counter() - start)
+
+
+def _setup(args, api_url):
+    logs.setup_logging()
+    worker.setup("bot")
+    session = AiohttpSession(api=TelegramAPIServer.from_base(api_url))
+    worker.bot = Bot(token=os.environ["BOT_TOKEN"], session=session,
+                     default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+
+    if not args.rate_limits:
+        # Меряем сам воркер, а не паузы, которые требует Telegram
+        delivery.PRIVATE_CHAT_INTERVAL = 0.0
+        delivery.GROUP_CHAT_INTERVAL = 0.0
+        worker.broadcaster = delivery.Broadcaster(global_rate=1e9)
+
+    db_path = os.path.join(TMP, "mysql.sqlite3")
+    create_database(db_path, otos=args.otos, taxes=args.taxes)
+    db._pool = SQLitePool(db_path, latency=args.db_latency_ms / 1000)
+    # Каждое нажатие — свой пользователь, чтобы антидребезг не склеивал нагрузку
+    worker.router.debounce = 0.0
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200, help="операций на сценарий")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--chats", type=int, default=20, help="получателей в сценарии рассылки")
+    parser.add_argument("--lines", type=int, default=40, help="строк в выписке")
+    parser.add_argument("--otos", type=int, default=300)
+    parser.add_argument("--taxes", type=int, default=50_000)
+    parser.add_argument("--api-latency-ms", type=float, default=30.0)
+    parser.add_argument("--db-latency-ms", type=float, default=5.0)
+    parser.add_argument("--rate-limits", action="store_true", help="оставить паузы рассылки как в бою")
+    args = parser.parse_args()
+
+    api = FakeBotAPI(latency=args.api_latency_ms / 1000)
+    _setup(args, await api.start())
+    n, c = args.requests, args.concurrency
+    print(f"Bot API +{args.api_latency_ms:g} мс, БД +{args.db_latency_ms:g} мс, параллельно {c}")
+
+    await run_load("кэш касс (холодный)", [worker.update_cashboxes_cache], 1)
+
+    events = [statement_event(args.lines, seed=i) for i in range(n)]
+    worker.summary_chat_ids = [1000]
+    await run_load("выписка → сводка → 1 чат",
+                   [lambda e=e: worker.process_statements([(e.chat_id, e.id, e.text)]) for e in events], c)
+
+    # Через handler() и очередь приёма: Telethon-события идут подряд, как при всплеске пересылок
+    worker.ingest_queue.start()
+    start = time.perf_counter()
+    for event in events:
+        await worker.handler(event)
+    await worker.ingest_queue.join()
+    wall = time.perf_counter() - start
+    print(f"{'очередь приёма (всплеск)':<28} n={n:<5} всего {wall * 1000:8.2f} мс  {n / wall:9.1f} оп/с")
+    worker.ingest_queue.stop()
+
+    worker.summary_chat_ids = list(range(2000, 2000 + args.chats))
+    fanout = max(1, n // args.chats)
+    await run_load(f"рассылка → {args.chats} чатов",
+                   [lambda e=e: worker.process_statements([(e.chat_id, e.id, e.text)]) for e in events[:fanout]], c)
+
+    tokens = list(worker.summaries._data)
+    update_id = iter(range(1, 10**9))
+
+    def press(data_for):
+        def factory():
+            i = next(update_id)
+            data = data_for(tokens[i % len(tokens)])
+            update = Update.model_validate(callback_update(i, 10_000 + i, 10_000 + i, i, data))
+            return worker.dp.feed_update(worker.bot, update)
+        return factory
+
+    views = [
+        ("кнопка: сводка (назад)", lambda t: callbacks.pack(callbacks.BACK, t)),
+        ("кнопка: счета", lambda t: callbacks.pack(callbacks.RAW, t)),
+        ("кнопка: кассы на 00:00", lambda t: callbacks.pack(callbacks.DAILY, t)),
+        ("кнопка: кассы стр. 2", lambda t: callbacks.pack(callbacks.DAILY, t, 2)),
+        ("кнопка: актуальные кассы", lambda t: callbacks.pack(callbacks.LIVE, t)),
+        ("кнопка: пошлины", lambda t: callbacks.pack(callbacks.TAXES, page=1)),
+        ("кнопка: пошлины стр. 2", lambda t: callbacks.pack(callbacks.TAXES, page=2)),
+        ("кнопка: обновить пошлины", lambda t: callbacks.REFRESH_TAXES),
+    ]
+    for name, data_for in views:
+        await run_load(name, [press(data_for) for _ in range(n)], c)
+
+    print("Вызовы Bot API:", dict(api.calls))
+    await worker.bot.session.close()
+    await api.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,212 @@
+"""Локальные заменители Telegram и MySQL для бенчмарков.
+
+FakeBotAPI — aiohttp-сервер, который отвечает на методы Bot API так, как это
+нужно воркеру (sendMessage, editMessageText, answerCallbackQuery), с
+настраиваемой задержкой. SQLitePool подставляется вместо db.ConnectionPool:
+запросы из repository.py выполняются на SQLite-копии схемы
+algon_finance_online_cashbox / oto / duty_payment_requisites /
+webto_user_region_list / tax. Сами функции воркера при этом не подменяются.
+"""
+import re
+import time
+import random
+import asyncio
+import sqlite3
+import threading
+import contextlib
+from collections import Counter
+from types import SimpleNamespace
+
+from aiohttp import web
+
+SCHEMA = """
+    CREATE TABLE oto (id INTEGER PRIMARY KEY, name TEXT);
+    CREATE TABLE algon_finance_online_cashbox (
+        id INTEGER PRIMARY KEY, oto_id INTEGER, name TEXT, `type` TEXT, balance NUMERIC
+    );
+    CREATE TABLE duty_payment_requisites (id INTEGER PRIMARY KEY, region_code TEXT, recipient_name TEXT);
+    CREATE TABLE webto_user_region_list (id INTEGER PRIMARY KEY, code TEXT);
+    CREATE TABLE tax (id INTEGER PRIMARY KEY, upno TEXT, region_id INTEGER, active INTEGER);
+    CREATE INDEX tax_active_region ON tax (active, region_id);
+"""
+
+
+def create_database(path, otos=300, regions=85, taxes=50_000, seed=1):
+    """Создаёт SQLite-базу со схемой и синтетическими данными"""
+    rnd = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    conn.executemany("INSERT INTO oto VALUES (?, ?)", [(i, f"ОТО №{i} «Техосмотр»") for i in range(1, otos + 1)])
+
+    cashboxes = []
+    for i in range(1, otos + 1):
+        for _ in range(rnd.randint(1, 3)):
+            cashboxes.append((i, f"Касса ОТО {i}", "online", round(rnd.uniform(-5_000, 500_000), 2)))
+    for i in range(otos // 10):
+        kind = "reg" if i % 2 else "manage_company"
+        cashboxes.append((None, f"Рег. касса {i}", kind, round(rnd.uniform(0, 1_000_000), 2)))
+    conn.executemany(
+        "INSERT INTO algon_finance_online_cashbox (oto_id, name, `type`, balance) VALUES (?, ?, ?, ?)", cashboxes
+    )
+
+    conn.executemany("INSERT INTO duty_payment_requisites VALUES (?, ?, ?)", [
+        (i, f"{i:02d}", f"УФК по региону {i:02d} (ГИБДД)") for i in range(1, regions + 1)
+    ])
+    conn.executemany("INSERT INTO webto_user_region_list VALUES (?, ?)", [
+        (i, f"{i:02d}") for i in range(1, regions + 1)
+    ])
+    conn.executemany("INSERT INTO tax (upno, region_id, active) VALUES (?, ?, ?)", [
+        (f"18810{rnd.randint(10**14, 10**15 - 1)}", rnd.randint(1, regions), 1 if rnd.random() < 0.7 else 0)
+        for _ in range(taxes)
+    ])
+    conn.commit()
+    conn.close()
+
+
+def _to_sqlite(sql):
+    """MySQL-диалект запросов repository.py → SQLite"""
+    sql = re.sub(r'"([^"]*)"', r"'\1'", sql)  # строки в двойных кавычках
+    sql = re.sub(r"\bIF\(", "IIF(", sql)
+    return sql.replace("%s", "?")
+
+
+class _Cursor:
+    def __init__(self, conn, latency):
+        self._conn = conn
+        self._latency = latency
+        self._cur = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self._cur is not None:
+            self._cur.close()
+
+    def execute(self, sql, args=None):
+        if self._latency:
+            time.sleep(self._latency)  # сетевая задержка до MySQL, в потоке исполнителя
+        self._cur = self._conn.execute(_to_sqlite(sql), args or ())
+
+    def fetchone(self):
+        row = self._cur.fetchone()
+        return dict(row) if row is not None else None
+
+    def fetchall(self):
+        return [dict(row) for row in self._cur.fetchall()]
+
+
+class _Connection:
+    def __init__(self, conn, latency):
+        self._conn = conn
+        self._latency = latency
+
+    def cursor(self):
+        return _Cursor(self._conn, self._latency)
+
+
+class SQLitePool:
+    """Тот же интерфейс, что у db.ConnectionPool; по соединению на поток исполнителя"""
+
+    def __init__(self, path, latency=0.0):
+        self.path = path
+        self.latency = latency
+        self._local = threading.local()
+        self._queries = 0
+
+    @contextlib.contextmanager
+    def connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+        self._queries += 1
+        yield _Connection(conn, self.latency)
+
+    def stats(self):
+        return {"backend": "sqlite", "checkouts": self._queries}
+
+    def close(self):
+        pass
+
+
+class FakeBotAPI:
+    """Заглушка Bot API: отвечает успехом с задержкой latency и считает вызовы"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self._message_id = 0
+        self._runner = None
+        self.url = None
+
+    async def _handle(self, request):
+        method = request.match_info["method"]
+        data = await request.post()
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        name = method.lower()
+        if name in ("sendmessage", "editmessagetext"):
+            if name == "sendmessage":
+                self._message_id += 1
+                message_id = self._message_id
+            else:
+                message_id = int(data.get("message_id", 0))
+            chat_id = int(data["chat_id"])
+            result = {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "group"},
+                "text": data.get("text", ""),
+            }
+        elif name == "getme":
+            result = {"id": 1, "is_bot": True, "first_name": "bench"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self, host="127.0.0.1", port=0):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+def statement_event(lines=40, seed=None, chat_id=-1001):
+    """Синтетическое событие Telethon с финансовым сообщением"""
+    rnd = random.Random(seed)
+    rows = ["Остатки на счетах"]
+    for i in range(lines):
+        amount = f"{rnd.randint(0, 50_000_000):,}".replace(",", "\xa0") + f",{rnd.randint(0, 99):02d}"
+        rows.append(f"^Счёт {i:03d} ООО «Ромашка»${amount}$")
+    return SimpleNamespace(text="\n".join(rows), chat_id=chat_id, id=rnd.randint(1, 10 ** 6))
+
+
+def callback_update(update_id, user_id, chat_id, message_id, data):
+    """Update с нажатием кнопки в формате Bot API"""
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": {"id": user_id, "is_bot": False, "first_name": "bench"},
+            "chat_instance": str(chat_id),
+            "data": data,
+            "message": {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": "...",
+            },
+        },
+    }
@@ -0,0 +1,123 @@
+"""Кэш со стратегией stale-while-revalidate.
+
+Устаревшее значение отдаётся сразу, а обновление запускается в фоне. Все
+одновременные обновления склеиваются в одну задачу, поэтому за одно окно TTL
+загрузчик вызывается не больше одного раза, сколько бы пользователей ни жали кнопку.
+"""
+import time
+import asyncio
+import logging
+import traceback
+from datetime import datetime
+
+import pytz
+
+import metrics
+
+
+class SWRCache:
+    """Кэш одного значения с фоновым обновлением.
+
+    loader — корутина без аргументов, возвращающая новое значение и
+    пробрасывающая ошибки. ttl=None означает, что значение не устаревает само
+    и обновляется только явным вызовом refresh() (например, по расписанию).
+    on_update(value, as_of) — необязательная корутина, вызывается после каждой
+    успешной загрузки (например, чтобы сохранить снимок на диск).
+    """
+
+    def __init__(self, name, loader, ttl=None, on_update=None):
+        self.name = name
+        self.ttl = ttl
+        self._loader = loader
+        self._on_update = on_update
+        self._value = None
+        self._as_of = None
+        self._loaded_at = None  # time.monotonic() последней успешной загрузки
+        self._refresh_task = None
+        self.last_error = None
+        metrics.on_collect(self._report_age)
+
+    @property
+    def value(self):
+        return self._value
+
+    @property
+    def as_of(self):
+        """Время (Europe/Moscow), на которое актуально значение, или None"""
+        return self._as_of
+
+    def age(self):
+        """Возраст значения в секундах или None, если значения ещё нет"""
+        if self._loaded_at is None:
+            return None
+        return time.monotonic() - self._loaded_at
+
+    def is_stale(self):
+        if self._value is None:
+            return True
+        return self.ttl is not None and self.age() > self.ttl
+
+    def is_refreshing(self):
+        return self._refresh_task is not None and not self._refresh_task.done()
+
+    def set(self, value, as_of=None):
+        """Кладёт в кэш значение, полученное в обход загрузчика"""
+        self._value = value
+        self._as_of = as_of or datetime.now(pytz.timezone('Europe/Moscow'))
+        self._loaded_at = time.monotonic()
+
+    async def get(self):
+        """Возвращает значение сразу; если его ещё нет — дожидается первой загрузки.
+
+        Если значение устарело, запускает фоновое обновление и отдаёт старое.
+        """
+        if self._value is None:
+            metrics.CACHE_REQUESTS.inc(cache=self.name, result="miss")
+            return await self.refresh()
+        if self.is_stale():
+            metrics.CACHE_REQUESTS.inc(cache=self.name, result="stale")
+            self.refresh_in_background()
+        else:
+            metrics.CACHE_REQUESTS.inc(cache=self.name, result="hit")
+        return self._value
+
+    def _report_age(self):
+        age = self.age()
+        metrics.CACHE_AGE_SECONDS.set(float("nan") if age is None else age, cache=self.name)
+
+    def refresh_in_background(self):
+        """Запускает обновление, если оно ещё не идёт. Возвращает задачу обновления"""
+        if not self.is_refreshing():
+            self._refresh_task = asyncio.create_task(self._refresh())
+        return self._refresh_task
+
+    async def refresh(self, raise_errors=False):
+        """Обновляет значение (присоединяясь к уже идущему обновлению) и возвращает его.
+
+        По умолчанию ошибка загрузки не пробрасывается: возвращается старое значение,
+        а ошибка остаётся в last_error. raise_errors=True — пробросить её (для задач по расписанию)
+        """
+        value = await asyncio.shield(self.refresh_in_background())
+        if raise_errors and self.last_error is not None:
+            raise self.last_error
+        return value
+
+    async def _refresh(self):
+        try:
+            value = await self._loader()
+        except Exception as e:
+            self.last_error = e
+            logging.error("Не удалось обновить кэш «%s»: %s", self.name, e)
+            logging.error(traceback.format_exc())
+            return self._value
+
+        self.last_error = None
+        self.set(value)
+        logging.info("Кэш «%s» обновлён в %s", self.name, self._as_of.strftime('%H:%M:%S'))
+
+        if self._on_update is not None:
+            try:
+                await self._on_update(value, self._as_of)
+            except Exception as e:
+                logging.error("Ошибка on_update для кэша «%s»: %s", self.name, e)
+        return self._value
@@ -0,0 +1,153 @@
+"""Формат callback_data кнопок и таблица маршрутов.
+
+callback_data имеет вид "<вид>:<снимок>:<страница>", например "r:Ab3_x-9Q:2".
+Вид — однобуквенный код представления, снимок — токен сводки или версия
+отчёта по пошлинам, страница — номер с единицы. Пустые хвостовые поля
+опускаются: "t::1", "u", "i".
+
+Обработчик выбирается одним поиском в словаре по виду, поэтому новые
+представления не удлиняют цепочку фильтров. Испорченные и чужие данные
+отсекаются при разборе, до вызова обработчика. Кнопки старого формата
+("show_raw:<токен>", "check_taxes:<страница>:<версия>") в уже отправленных
+сообщениях продолжают работать через псевдонимы.
+"""
+import os
+import re
+import time
+import logging
+from dataclasses import dataclass
+
+import logs
+import loop_watchdog
+from store import LRUStore
+
+LIVE = "d"           # актуальные кассы
+DAILY = "c"          # кассы на 00:00
+RAW = "r"            # счета из выписки
+BACK = "b"           # назад к сводке
+TAXES = "t"          # страница отчёта по пошлинам
+REFRESH_TAXES = "u"  # принудительное обновление пошлин
+IGNORE = "i"         # номер страницы, ничего не делает
+
+# Старое имя → (вид, страница идёт перед снимком)
+LEGACY_NAMES = {
+    "show_details": (LIVE, False),
+    "show_cached_cashboxes": (DAILY, False),
+    "show_raw": (RAW, False),
+    "back_to_main": (BACK, False),
+    "check_taxes": (TAXES, True),
+    "refresh_taxes": (REFRESH_TAXES, False),
+    "ignore": (IGNORE, False),
+}
+
+MAX_CALLBACK_DATA = 64  # ограничение Telegram
+MAX_PAGE = 9999
+_SNAPSHOT_RE = re.compile(r"[A-Za-z0-9_-]{0,16}")
+
+# Повторное нажатие той же кнопки тем же пользователем в этом окне игнорируется
+CALLBACK_DEBOUNCE_SECONDS = float(os.getenv("CALLBACK_DEBOUNCE_SECONDS", 1.0) or 0)
+
+
+@dataclass(frozen=True)
+class Payload:
+    view: str
+    snapshot: str = ""
+    page: int = 1
+
+
+def pack(view, snapshot="", page=None):
+    """callback_data для кнопки; пустые хвостовые поля не пишутся"""
+    if page is not None:
+        return f"{view}:{snapshot}:{page}"
+    if snapshot:
+        return f"{view}:{snapshot}"
+    return view
+
+
+def parse(data):
+    """Разбирает callback_data в Payload или возвращает None, если данные испорчены"""
+    if not data or len(data) > MAX_CALLBACK_DATA:
+        return None
+
+    parts = data.split(":", 3)
+    if len(parts) > 3:
+        return None
+    view, snapshot, page = parts + [""] * (3 - len(parts))
+
+    if len(view) > 1:
+        legacy = LEGACY_NAMES.get(view)
+        if legacy is None:
+            return None
+        view, page_first = legacy
+        if page_first:
+            snapshot, page = page, snapshot
+
+    if not _SNAPSHOT_RE.fullmatch(snapshot):
+        return None
+    if not page:
+        return Payload(view, snapshot)
+    if not page.isdigit() or not 1 <= int(page) <= MAX_PAGE:
+        return None
+    return Payload(view, snapshot, int(page))
+
+
+class Router:
+    """Таблица вид → обработчик(callback, payload) с разбором callback_data.
+
+    Нажатия склеиваются по ключу (пользователь, сообщение, callback_data):
+    пока обработчик для ключа выполняется, повторные нажатия только гасят
+    часики на кнопке, а после завершения ещё debounce секунд игнорируются.
+    """
+
+    def __init__(self, debounce=CALLBACK_DEBOUNCE_SECONDS):
+        self.debounce = debounce
+        self._routes = {}
+        self._in_flight = set()
+        self._finished = LRUStore(maxsize=1000)  # ключ → time.monotonic() завершения
+
+    def route(self, view):
+        """Декоратор: регистрирует обработчик для вида (с замером времени, см. loop_watchdog)"""
+        def register(handler):
+            if view in self._routes:
+                raise ValueError(f"Для вида {view!r} уже есть обработчик")
+            self._routes[view] = loop_watchdog.traced(handler)
+            return handler
+        return register
+
+    @staticmethod
+    def _press_key(callback):
+        message = callback.message
+        where = (message.chat.id, message.message_id) if message else callback.inline_message_id
+        return callback.from_user.id, where, callback.data
+
+    def _recently_finished(self, key):
+        finished_at = self._finished.get(key)
+        return finished_at is not None and time.monotonic() - finished_at < self.debounce
+
+    async def dispatch(self, callback):
+        payload = parse(callback.data)
+        handler = self._routes.get(payload.view) if payload else None
+        if handler is None:
+            logging.debug("Отброшен callback с неизвестными данными: %r", callback.data)
+            await callback.answer()
+            return
+
+        key = self._press_key(callback)
+        if key in self._in_flight:
+            # Результат первого нажатия сам появится в сообщении
+            await callback.answer("Обновляю…")
+            return
+        if self._recently_finished(key):
+            logging.debug("Повторное нажатие %r пропущено", callback.data)
+            await callback.answer()
+            return
+
+        self._in_flight.add(key)
+        try:
+            # cid нажатия — токен снимка, к которому относится кнопка
+            with logs.correlation(payload.snapshot or f"cb-{callback.id}"):
+                logging.debug("Нажатие %r", callback.data)
+                await handler(callback, payload)
+        finally:
+            self._in_flight.discard(key)
+            self._finished.put(key, time.monotonic())
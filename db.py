@@ -0,0 +1,258 @@
+"""Асинхронный доступ к MySQL.
+
+pymysql — синхронный драйвер, поэтому каждый запрос выполняется в отдельном
+пуле потоков. Event loop в это время продолжает обслуживать Telethon и aiogram,
+и медленный отчёт не задерживает ни сводку, ни нажатия кнопок.
+
+Соединения берутся из общего ограниченного пула, который создаётся один раз
+при старте (init_pool) и переиспользует TCP-сессии между запросами.
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+import contextlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import pymysql
+
+import metrics
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 4) or 4)
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 10) or 10)  # сек. ожидания свободного соединения
+DB_MAX_IDLE = float(os.getenv("DB_MAX_IDLE", 300) or 300)  # сек. простоя, после которых соединение пересоздаётся
+
+_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="mysql")
+_pool = None
+
+
+class PoolTimeout(pymysql.OperationalError):
+    """Не удалось получить соединение из пула за DB_POOL_TIMEOUT секунд"""
+
+
+class ConnectionPool:
+    """Ограниченный пул соединений pymysql.
+
+    Методы вызываются только из потоков исполнителя, поэтому синхронизация
+    сделана на примитивах threading, а не asyncio.
+    """
+
+    def __init__(self, params, size, timeout, max_idle):
+        self._params = params
+        self._size = size
+        self._timeout = timeout
+        self._max_idle = max_idle
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._idle = deque()  # (conn, время возврата в пул)
+        self._open = 0
+        self._in_use = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._created = 0
+        self._recycled = 0
+        self._reconnects = 0
+
+    def _connect(self):
+        # autocommit обязателен: иначе переиспользуемое соединение держит
+        # снимок REPEATABLE READ и видит устаревшие остатки
+        conn = pymysql.connect(
+            **self._params, cursorclass=pymysql.cursors.DictCursor, autocommit=True
+        )
+        with self._lock:
+            self._open += 1
+            self._created += 1
+        metrics.DB_POOL_EVENTS.inc(event="created")
+        return conn
+
+    def _discard(self, conn):
+        with contextlib.suppress(Exception):
+            conn.close()
+        with self._lock:
+            self._open -= 1
+
+    def _recycle_expired(self):
+        """Закрывает соединения, простоявшие дольше max_idle.
+
+        Берём самое свежее соединение (pop справа), поэтому старые копятся слева —
+        их проверяем отдельно, иначе они дожили бы до ближайшего всплеска нагрузки.
+        """
+        deadline = time.monotonic() - self._max_idle
+        expired = []
+        with self._lock:
+            while self._idle and self._idle[0][1] < deadline:
+                expired.append(self._idle.popleft()[0])
+            self._recycled += len(expired)
+        for conn in expired:
+            self._discard(conn)
+        if expired:
+            metrics.DB_POOL_EVENTS.inc(len(expired), event="recycled")
+
+    def _checkout(self):
+        self._recycle_expired()
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                conn, _ = self._idle.pop()
+
+            try:
+                conn.ping(reconnect=False)
+                return conn
+            except Exception:
+                logging.warning("Соединение из пула БД не отвечает, переподключаемся")
+                self._discard(conn)
+                with self._lock:
+                    self._reconnects += 1
+                metrics.DB_POOL_EVENTS.inc(event="reconnect")
+
+        return self._connect()
+
+    @contextlib.contextmanager
+    def connection(self):
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=self._timeout):
+            raise PoolTimeout(f"Нет свободного соединения с БД за {self._timeout:.0f} с")
+        waited = time.monotonic() - started
+        metrics.DB_POOL_WAIT_SECONDS.observe(waited)
+
+        with self._lock:
+            self._checkouts += 1
+            self._in_use += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+            if waited > 0.001:
+                self._waits += 1
+
+        conn = None
+        try:
+            conn = self._checkout()
+            yield conn
+        except (pymysql.OperationalError, pymysql.InterfaceError):
+            if conn is not None:
+                self._discard(conn)
+                conn = None
+            raise
+        finally:
+            if conn is not None:
+                with self._lock:
+                    self._idle.append((conn, time.monotonic()))
+            with self._lock:
+                self._in_use -= 1
+            self._slots.release()
+            self._recycle_expired()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = list(self._idle), deque()
+        for conn, _ in idle:
+            self._discard(conn)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": self._size,
+                "open": self._open,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "checkouts": self._checkouts,
+                "waits": self._waits,
+                "wait_seconds_total": round(self._wait_total, 6),
+                "wait_seconds_max": round(self._wait_max, 6),
+                "created": self._created,
+                "recycled": self._recycled,
+                "reconnects": self._reconnects,
+            }
+
+
+def _db_params():
+    return {
+        "user": os.getenv("DB_USER"),
+        "password": os.getenv("DB_PASS"),
+        "host": os.getenv("DB_HOST"),
+        "port": int(os.getenv("DB_PORT", 3366) or 3366),
+        "database": os.getenv("DB_NAME"),
+        "charset": 'utf8mb4',
+    }
+
+
+def init_pool():
+    """Создаёт общий пул соединений. Параметры читаются из окружения один раз"""
+    global _pool
+    if _pool is not None:
+        return _pool
+
+    params = _db_params()
+    if any(v in (None, "") for v in params.values()):
+        logging.error("Параметры подключения к БД неполные, пул не создан")
+        return None
+
+    _pool = ConnectionPool(params, DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_MAX_IDLE)
+    logging.info("Пул соединений с БД создан: до %s соединений", DB_POOL_SIZE)
+    return _pool
+
+
+def is_configured():
+    """True, если пул создан и параметры подключения заданы"""
+    return _pool is not None
+
+
+def stats():
+    """Метрики пула: размер, занятые соединения, ожидание свободного слота"""
+    return _pool.stats() if _pool else {}
+
+
+@metrics.on_collect
+def _report_pool():
+    current = stats()
+    for state in ("size", "open", "idle", "in_use"):
+        metrics.DB_POOL_CONNECTIONS.set(current.get(state, 0), state=state)
+
+
+def _execute(sql, args, one):
+    """Синхронная часть: выполняется только в потоке исполнителя"""
+    if _pool is None:
+        raise pymysql.OperationalError("Пул соединений с БД не инициализирован")
+
+    with _pool.connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql, args)
+            if one:
+                return cur.fetchone()
+            return list(cur.fetchall())
+
+
+async def _run(sql, args, one, name):
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    try:
+        return await loop.run_in_executor(_executor, _execute, sql, args, one)
+    except Exception:
+        metrics.DB_QUERY_ERRORS.inc(query=name)
+        raise
+    finally:
+        # Вместе с ожиданием свободного потока и соединения — так, как это видит вызывающий
+        metrics.DB_QUERY_SECONDS.observe(time.perf_counter() - start, query=name)
+
+
+async def fetch_all(sql, args=None, name="other"):
+    """Выполняет запрос в пуле потоков и возвращает список строк-словарей.
+    name — имя запроса для метрик
+    """
+    return await _run(sql, args, False, name)
+
+
+async def fetch_one(sql, args=None, name="other"):
+    """Выполняет запрос в пуле потоков и возвращает первую строку или None"""
+    return await _run(sql, args, True, name)
+
+
+def shutdown():
+    """Закрывает соединения пула и останавливает пул потоков"""
+    _executor.shutdown(wait=False, cancel_futures=True)
+    if _pool is not None:
+        _pool.close()
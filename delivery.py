@@ -0,0 +1,119 @@
+"""Рассылка сводок по нескольким чатам с учётом лимитов Telegram.
+
+Сообщения во все чаты уходят параллельно, но не чаще, чем разрешает Telegram:
+около одного сообщения в секунду в личный чат, 20 в минуту в группу и ~30 в
+секунду на бота в целом. RetryAfter и сетевые ошибки повторяются с паузой,
+ошибка одного чата не мешает доставке в остальные.
+"""
+import os
+import time
+import asyncio
+import logging
+
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError
+
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", 3) or 3)
+GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", 25) or 25)  # сообщений в секунду на бота
+PRIVATE_CHAT_INTERVAL = 1.0  # сек. между сообщениями в личный чат
+GROUP_CHAT_INTERVAL = 3.0  # сек. между сообщениями в группу (20 в минуту)
+
+
+def parse_chat_ids(*values):
+    """Собирает ID чатов из строк вида "1,-100200" без повторов, сохраняя порядок"""
+    result = []
+    for value in values:
+        for part in (value or "").split(","):
+            part = part.strip()
+            if not part:
+                continue
+            try:
+                chat_id = int(part)
+            except ValueError:
+                logging.warning("Некорректный ID чата в настройках: %r", part)
+                continue
+            if chat_id not in result:
+                result.append(chat_id)
+    return result
+
+
+class _Interval:
+    """Выдаёт слоты не чаще одного за interval секунд"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._next = 0.0
+
+    def delay(self, seconds):
+        """Сдвигает ближайший слот (например, после RetryAfter)"""
+        self._next = max(self._next, time.monotonic() + seconds)
+
+    async def wait(self):
+        # Резервируем слот без await, поэтому в asyncio блокировка не нужна
+        now = time.monotonic()
+        slot = max(now, self._next)
+        self._next = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+class Broadcaster:
+    """Параллельная отправка и правка сообщений с ограничением частоты и повторами"""
+
+    def __init__(self, global_rate=GLOBAL_RATE, max_retries=SEND_MAX_RETRIES):
+        self._global = _Interval(1.0 / global_rate)
+        self._chats = {}
+        self._max_retries = max_retries
+
+    def _chat_interval(self, chat_id):
+        if chat_id not in self._chats:
+            interval = GROUP_CHAT_INTERVAL if chat_id < 0 else PRIVATE_CHAT_INTERVAL
+            self._chats[chat_id] = _Interval(interval)
+        return self._chats[chat_id]
+
+    async def _call(self, chat_id, method, **kwargs):
+        chat_limit = self._chat_interval(chat_id)
+        for attempt in range(self._max_retries + 1):
+            await chat_limit.wait()
+            await self._global.wait()
+            try:
+                return await method(chat_id=chat_id, **kwargs)
+            except TelegramRetryAfter as e:
+                if attempt == self._max_retries:
+                    raise
+                logging.warning("Flood control для чата %s: ждём %s с", chat_id, e.retry_after)
+                chat_limit.delay(e.retry_after)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                if attempt == self._max_retries:
+                    raise
+                backoff = 2 ** attempt
+                logging.warning("Ошибка отправки в чат %s: %s, повтор через %s с", chat_id, e, backoff)
+                chat_limit.delay(backoff)
+
+    async def _gather(self, calls):
+        results = await asyncio.gather(*(call for _, call in calls), return_exceptions=True)
+        ok = []
+        for (chat_id, _), result in zip(calls, results):
+            if isinstance(result, Exception):
+                logging.error("Не удалось доставить сообщение в чат %s: %s", chat_id, result)
+            else:
+                ok.append(result)
+        return ok
+
+    async def send(self, bot, chat_ids, text, reply_markup=None):
+        """Отправляет сообщение во все чаты. Возвращает успешно отправленные Message"""
+        calls = [
+            (chat_id, self._call(chat_id, bot.send_message, text=text, reply_markup=reply_markup))
+            for chat_id in dict.fromkeys(chat_ids)
+        ]
+        return await self._gather(calls)
+
+    async def edit(self, bot, messages, text, reply_markup=None):
+        """Правит уже отправленные сообщения. Возвращает успешно изменённые"""
+        calls = [
+            (message.chat.id, self._call(
+                message.chat.id, bot.edit_message_text,
+                message_id=message.message_id, text=text, reply_markup=reply_markup
+            ))
+            for message in messages
+        ]
+        return await self._gather(calls)
@@ -0,0 +1,88 @@
+"""Очередь приёма выписок между Telethon и построением сводки.
+
+Обработчик Telethon только кладёт текст в ограниченную очередь. Если очередь
+полна, он ждёт, и это притормаживает приём обновлений вместо того, чтобы
+копить неограниченное число параллельных обработчиков. Сборщик забирает
+сообщения пачками: всё, что пришло в течение окна склейки после первого
+сообщения, уходит в одну сводку. Пачки обрабатывает фиксированное число
+воркеров.
+"""
+import os
+import asyncio
+import logging
+import traceback
+
+import metrics
+
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", 100) or 100)
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", 2) or 2)
+# 0 — каждая выписка даёт свою сводку, как раньше
+INGEST_COALESCE_SECONDS = float(os.getenv("INGEST_COALESCE_SECONDS", 0) or 0)
+INGEST_MAX_BATCH = 20
+
+
+class IngestQueue:
+    """Ограниченная очередь со сборщиком пачек и пулом воркеров.
+
+    process(batch) — корутина, получающая список элементов одной пачки.
+    """
+
+    def __init__(self, process, maxsize=INGEST_QUEUE_SIZE, workers=INGEST_WORKERS,
+                 window=INGEST_COALESCE_SECONDS, max_batch=INGEST_MAX_BATCH):
+        self._process = process
+        self.workers = workers
+        self.window = window
+        self.max_batch = max_batch
+        self._incoming = asyncio.Queue(maxsize=maxsize)
+        # Не больше одной готовой пачки на воркер: дальше ждёт сборщик, за ним — put()
+        self._batches = asyncio.Queue(maxsize=workers)
+        self._tasks = []
+        metrics.on_collect(self._report_depth)
+
+    def start(self):
+        """Запускает сборщик и воркеры на текущем event loop (повторный вызов ничего не делает)"""
+        if self._tasks:
+            return
+        self._tasks.append(asyncio.create_task(self._collect()))
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._work()))
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    async def put(self, item):
+        if self._incoming.full():
+            logging.warning("Очередь приёма заполнена (%s), приём ждёт обработки", self._incoming.maxsize)
+        await self._incoming.put(item)
+
+    async def join(self):
+        """Ждёт, пока всё положенное в очередь будет обработано"""
+        await self._incoming.join()
+
+    def _report_depth(self):
+        metrics.INGEST_QUEUE_DEPTH.set(self._incoming.qsize())
+
+    async def _collect(self):
+        while True:
+            batch = [await self._incoming.get()]
+            if self.window > 0:
+                # Ждём окно целиком, затем забираем всё, что успело прийти
+                await asyncio.sleep(self.window)
+                while len(batch) < self.max_batch and not self._incoming.empty():
+                    batch.append(self._incoming.get_nowait())
+            metrics.INGEST_BATCH_SIZE.observe(len(batch))
+            await self._batches.put(batch)
+
+    async def _work(self):
+        while True:
+            batch = await self._batches.get()
+            try:
+                await self._process(batch)
+            except Exception as e:
+                logging.error("Ошибка обработки пачки из %s выписок: %s", len(batch), e)
+                logging.error(traceback.format_exc())
+            finally:
+                for _ in batch:
+                    self._incoming.task_done()
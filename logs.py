@@ -0,0 +1,66 @@
+"""Настройка логирования: уровень и формат из окружения, correlation id.
+
+LOG_FORMAT=text — привычные строки, LOG_FORMAT=json — одна JSON-запись на
+строку для сборщиков логов. В каждую запись добавляется поле cid: токен
+сводки, к которой относится событие. Его получают входящее сообщение Telethon,
+рассылка сводки, фоновая правка и все нажатия кнопок этой сводки, поэтому
+по одному cid видна вся цепочка.
+
+Сообщения в коде пишутся с %-аргументами (logging.debug("... %s", x)):
+строка собирается только если запись действительно пройдёт по уровню.
+"""
+import os
+import json
+import logging
+import contextlib
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - [%(cid)s] %(message)s'
+
+correlation_id = ContextVar("correlation_id", default="-")
+
+
+@contextlib.contextmanager
+def correlation(cid):
+    """cid только на время блока"""
+    token = correlation_id.set(cid or "-")
+    try:
+        yield
+    finally:
+        correlation_id.reset(token)
+
+
+class CorrelationFilter(logging.Filter):
+    def filter(self, record):
+        record.cid = correlation_id.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "cid": getattr(record, "cid", "-"),
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def setup_logging(level=LOG_LEVEL, fmt=LOG_FORMAT):
+    handler = logging.StreamHandler()
+    handler.addFilter(CorrelationFilter())
+    handler.setFormatter(JsonFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT))
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+    root.addHandler(handler)
+    numeric = logging.getLevelName(level)
+    root.setLevel(numeric if isinstance(numeric, int) else logging.INFO)
@@ -0,0 +1,127 @@
+"""Сторож event loop и трассировка медленных обработчиков.
+
+LoopWatchdog — задача-«пульс» на event loop и отдельный поток, который за ней
+следит. Задача раз в WATCHDOG_INTERVAL секунд отмечается и пишет опоздание
+loop в метрики. Если отметки нет дольше LOOP_BLOCK_SECONDS, поток снимает стек
+потока event loop и пишет его в лог вместе с именем обработчика, который в
+этот момент выполнялся, — это и есть виновник зависания.
+
+traced() (и TracingMiddleware для aiogram) оборачивает корутину-обработчик: меряет полное время и время каждого
+шага между await. Шаг дольше LOOP_BLOCK_SECONDS — это синхронный код,
+который держал loop, и он попадает в лог и в метрики.
+"""
+import os
+import sys
+import time
+import asyncio
+import logging
+import functools
+import threading
+import traceback
+
+from aiogram import BaseMiddleware
+
+import metrics
+
+LOOP_BLOCK_SECONDS = float(os.getenv("LOOP_BLOCK_SECONDS", 0.5) or 0.5)
+WATCHDOG_INTERVAL = 0.25
+
+# Имена обработчиков, чей шаг выполняется прямо сейчас (читается из потока сторожа)
+_running = []
+
+
+class _Traced:
+    """Прогоняет корутину по шагам, замеряя каждый шаг"""
+
+    __slots__ = ("name", "coro")
+
+    def __init__(self, name, coro):
+        self.name = name
+        self.coro = coro
+
+    def __await__(self):
+        coro = self.coro
+        value, error = None, None
+        started = time.perf_counter()
+        try:
+            while True:
+                step_started = time.perf_counter()
+                _running.append(self.name)
+                try:
+                    if error is None:
+                        future = coro.send(value)
+                    else:
+                        future = coro.throw(error)
+                except StopIteration as stop:
+                    return stop.value
+                finally:
+                    _running.pop()
+                    step = time.perf_counter() - step_started
+                    if step > LOOP_BLOCK_SECONDS:
+                        metrics.HANDLER_BLOCKING.inc(handler=self.name)
+                        logging.warning("Обработчик %s держал event loop %.2f с без await", self.name, step)
+                try:
+                    value, error = (yield future), None
+                except BaseException as e:
+                    value, error = None, e
+        finally:
+            metrics.HANDLER_SECONDS.observe(time.perf_counter() - started, handler=self.name)
+
+
+def traced(func):
+    """Декоратор для async-обработчиков aiogram и Telethon"""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await _Traced(func.__name__, func(*args, **kwargs))
+    return wrapper
+
+
+class TracingMiddleware(BaseMiddleware):
+    """То же, что traced(), для всех обработчиков одного типа событий aiogram"""
+
+    async def __call__(self, handler, event, data):
+        callback = getattr(data.get("handler"), "callback", handler)
+        return await _Traced(getattr(callback, "__name__", "aiogram"), handler(event, data))
+
+
+class LoopWatchdog:
+    """Пульс event loop и поток, который снимает стек при зависании"""
+
+    def __init__(self, threshold=LOOP_BLOCK_SECONDS, interval=WATCHDOG_INTERVAL):
+        self.threshold = threshold
+        self.interval = interval
+        self._beat = time.monotonic()
+        self._loop_thread_id = None
+        self._stop = threading.Event()
+
+    async def run(self):
+        """Задача-пульс; поток-сторож стартует вместе с ней и останавливается при её отмене"""
+        loop = asyncio.get_running_loop()
+        self._loop_thread_id = threading.get_ident()
+        self._beat = time.monotonic()
+        thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = loop.time()
+                self._beat = time.monotonic()
+                await asyncio.sleep(self.interval)
+                metrics.LOOP_LAG_SECONDS.observe(max(0.0, loop.time() - start - self.interval))
+        finally:
+            self._stop.set()
+
+    def _watch(self):
+        reported = None
+        while not self._stop.wait(self.interval):
+            beat = self._beat
+            stalled = time.monotonic() - beat - self.interval
+            if stalled <= self.threshold or beat == reported:
+                continue
+            # Одна запись на одно зависание
+            reported = beat
+            metrics.LOOP_STALLS.inc()
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "стек недоступен\n"
+            culprit = _running[-1] if _running else "неизвестно (не обработчик)"
+            logging.warning("Event loop не отвечает уже %.2f с, выполняется: %s\nСтек потока event loop:\n%s",
+                            stalled, culprit, stack)
@@ -0,0 +1,223 @@
+"""Метрики воркера в текстовом формате Prometheus.
+
+Счётчики, гистограммы и датчики живут в памяти процесса и обновляются из
+кода (в том числе из потоков БД). Если задан METRICS_PORT, на том же event
+loop поднимается aiohttp-сервер с /metrics. Без него метрики всё равно
+копятся, но наружу не отдаются.
+"""
+import os
+import time
+import math
+import logging
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from aiohttp import web
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0) or 0)
+# Файл, куда планировщик периодически сбрасывает метрики; {role} заменяется ролью процесса
+METRICS_TEXTFILE = os.getenv("METRICS_TEXTFILE", "")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+ROW_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+
+_metrics = []
+_collectors = []
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.extend(self._render_sample(key, value))
+        return lines
+
+    def _render_sample(self, key, value):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # счётчики по корзинам (последняя — +Inf), сумма, количество
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_sample(self, key, state):
+        counts, total, count = state[0][:], state[1], state[2]
+        lines = []
+        cumulative = 0
+        for bound, n in zip(self.buckets + (math.inf,), counts):
+            cumulative += n
+            le = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+            lines.append(f"{self.name}_bucket{le} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+def on_collect(func):
+    """Регистрирует функцию, которая обновляет датчики перед каждой выдачей /metrics"""
+    _collectors.append(func)
+    return func
+
+
+def render():
+    """Все метрики в текстовом формате Prometheus"""
+    for func in _collectors:
+        try:
+            func()
+        except Exception as e:
+            logging.error("Ошибка сборщика метрик %s: %s", func.__name__, e)
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+DB_QUERY_SECONDS = Histogram("worker_db_query_seconds", "Время выполнения запроса к MySQL", ["query"])
+DB_QUERY_ERRORS = Counter("worker_db_query_errors_total", "Ошибки запросов к MySQL", ["query"])
+DB_POOL_CONNECTIONS = Gauge("worker_db_pool_connections",
+                            "Соединения пула MySQL: size — предел, open, idle, in_use", ["state"])
+DB_POOL_WAIT_SECONDS = Histogram("worker_db_pool_wait_seconds", "Ожидание свободного соединения в пуле MySQL")
+DB_POOL_EVENTS = Counter("worker_db_pool_events_total",
+                         "Соединения пула MySQL: created, recycled (простой дольше DB_MAX_IDLE), reconnect",
+                         ["event"])
+PARSE_SECONDS = Histogram("worker_parse_seconds", "Время разбора финансового сообщения")
+PARSE_ROWS = Histogram("worker_parse_rows", "Строк в разобранном сообщении", buckets=ROW_BUCKETS)
+TELEGRAM_REQUEST_SECONDS = Histogram("worker_telegram_request_seconds", "Время запроса к Bot API", ["method"])
+TELEGRAM_REQUEST_ERRORS = Counter("worker_telegram_request_errors_total", "Ошибки запросов к Bot API",
+                                  ["method", "error"])
+CACHE_REQUESTS = Counter("worker_cache_requests_total", "Обращения к кэшу: hit, stale или miss",
+                         ["cache", "result"])
+CACHE_AGE_SECONDS = Gauge("worker_cache_age_seconds", "Возраст значения в кэше (NaN — значения нет)", ["cache"])
+LOOP_LAG_SECONDS = Histogram("worker_event_loop_lag_seconds", "Опоздание event loop относительно таймера")
+LOOP_STALLS = Counter("worker_event_loop_stalls_total", "Зависания event loop дольше LOOP_BLOCK_SECONDS")
+INGEST_QUEUE_DEPTH = Gauge("worker_ingest_queue_depth", "Выписок в очереди приёма")
+INGEST_BATCH_SIZE = Histogram("worker_ingest_batch_size", "Выписок в одной сводке", buckets=(1, 2, 3, 5, 10, 20))
+HANDLER_SECONDS = Histogram("worker_handler_seconds", "Полное время обработчика", ["handler"])
+HANDLER_BLOCKING = Counter("worker_handler_blocking_total",
+                           "Шаги обработчика, державшие event loop дольше LOOP_BLOCK_SECONDS", ["handler"])
+JOB_RUNS = Counter("worker_job_runs_total", "Запуски задач планировщика: ok, error, timeout", ["job", "result"])
+JOB_SECONDS = Histogram("worker_job_seconds", "Время выполнения задачи планировщика", ["job"])
+JOB_LAST_SUCCESS = Gauge("worker_job_last_success_timestamp_seconds", "Unix-время последнего успешного запуска",
+                         ["job"])
+STARTUP_SECONDS = Gauge("worker_startup_seconds",
+                        "Секунд от запуска процесса до готовности компонента (ready — всех)", ["component"])
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии aiogram: время и ошибки каждого метода Bot API"""
+
+    async def __call__(self, make_request, bot, method):
+        name = getattr(method, "__api_method__", type(method).__name__)
+        start = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            TELEGRAM_REQUEST_ERRORS.inc(method=name, error=type(e).__name__)
+            raise
+        finally:
+            TELEGRAM_REQUEST_SECONDS.observe(time.perf_counter() - start, method=name)
+
+
+def write_textfile(path):
+    """Пишет все метрики в файл (для textfile collector node_exporter). Замена атомарная"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(render())
+    os.replace(tmp, path)
+
+
+async def _handle_metrics(request):
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Поднимает /metrics на текущем event loop. Без порта ничего не делает и возвращает None"""
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", _handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logging.info("Метрики доступны на http://%s:%s/metrics", host, port)
+    return runner
@@ -0,0 +1,375 @@
+"""Тексты и клавиатуры сообщений бота.
+
+Каждое представление (сводка, счета, кассы на 00:00, актуальные кассы,
+страницы пошлин) строится один раз на снимок данных и запоминается, так что
+повторное нажатие кнопки берёт готовый результат. DisplayTracker помнит, что
+уже показано в каждом сообщении, чтобы не вызывать edit_message_text с тем же
+содержимым.
+
+Длинные представления режутся на страницы функцией paginate(): длина
+считается в UTF-16 (как в Telegram), а резать блок можно только между тегами.
+"""
+import os
+import re
+import html
+from dataclasses import dataclass
+
+from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+import callbacks
+from store import LRUStore
+
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", 500) or 500)
+DISPLAY_TRACKER_SIZE = int(os.getenv("DISPLAY_TRACKER_SIZE", 1000) or 1000)
+TELEGRAM_TEXT_LIMIT = 4096
+
+
+def utf16_len(text):
+    """Длина текста так, как её считает Telegram (в кодовых единицах UTF-16)"""
+    return len(text.encode("utf-16-le")) // 2
+
+
+# Тег, HTML-сущность или один символ — неделимые куски при разрезании блока
+_HTML_TOKEN_RE = re.compile(r"<[^>]*>|&#?\w+;|[^<&]", re.S)
+_TAG_NAME_RE = re.compile(r"</?\s*(\w+)")
+
+
+def _split_html(block, budget):
+    """Режет слишком длинный блок на куски не длиннее budget, не разрывая теги.
+
+    Открытые на месте разреза теги закрываются в конце куска и открываются
+    заново в начале следующего. Открывающий тег попадает в кусок только вместе
+    с первым символом своего содержимого, и место под его закрывающий тег
+    резервируется сразу: кусок не заканчивается пустым <b></b> и не вылезает за budget.
+    """
+    chunks = []
+    current, current_len, has_text = [], 0, False
+    open_tags = []  # (имя, открывающий тег), уже вошедшие в текущий кусок
+    pending = []  # открывающие теги, у которых ещё нет содержимого
+
+    def closing(tags):
+        return "".join(f"</{name}>" for name, _ in reversed(tags))
+
+    for token in _HTML_TOKEN_RE.findall(block):
+        if token.startswith("<"):
+            match = _TAG_NAME_RE.match(token)
+            name = match.group(1).lower() if match else ""
+            if token.startswith("</"):
+                if any(tag_name == name for tag_name, _ in pending):
+                    # Пустой элемент (<b></b>) ничего не показывает — выбрасываем
+                    for i in range(len(pending) - 1, -1, -1):
+                        if pending[i][0] == name:
+                            del pending[i]
+                            break
+                    continue
+                for i in range(len(open_tags) - 1, -1, -1):
+                    if open_tags[i][0] == name:
+                        del open_tags[i]
+                        break
+                # Его длина уже зарезервирована в closing()
+                current.append(token)
+                current_len += utf16_len(token)
+                continue
+            if name and not token.endswith("/>"):
+                pending.append((name, token))
+                continue
+
+        opening = "".join(tag for _, tag in pending)
+        cost = utf16_len(opening) + utf16_len(token) + utf16_len(closing(pending))
+        if has_text and current_len + cost + utf16_len(closing(open_tags)) > budget:
+            chunks.append("".join(current) + closing(open_tags))
+            reopened = "".join(tag for _, tag in open_tags)
+            current, current_len, has_text = [reopened], utf16_len(reopened), False
+
+        current.append(opening)
+        open_tags.extend(pending)
+        pending.clear()
+        current.append(token)
+        current_len += utf16_len(opening) + utf16_len(token)
+        has_text = True
+
+    if has_text:
+        chunks.append("".join(current) + closing(open_tags))
+    return chunks
+
+
+def paginate(blocks, first_header="", header=None, suffix="", tail="", separator="\n",
+             limit=TELEGRAM_TEXT_LIMIT):
+    """Раскладывает HTML-блоки по страницам не длиннее limit (в UTF-16).
+
+    first_header — шапка первой страницы, header — остальных (по умолчанию та же),
+    suffix — конец каждой страницы (например, "</pre>"), tail — конец последней.
+    Блок целиком переносится на следующую страницу; блок длиннее страницы
+    режется по границам тегов.
+    """
+    if header is None:
+        header = first_header
+    budget = limit - max(utf16_len(first_header), utf16_len(header)) - utf16_len(suffix) - utf16_len(tail)
+    sep_len = utf16_len(separator)
+
+    pieces = []
+    for block in blocks:
+        if utf16_len(block) > budget:
+            pieces.extend(_split_html(block, budget))
+        else:
+            pieces.append(block)
+
+    bodies = []
+    current, current_len = [], 0
+    for piece in pieces:
+        piece_len = utf16_len(piece)
+        if current and current_len + sep_len + piece_len > budget:
+            bodies.append(current)
+            current, current_len = [], 0
+        current_len += piece_len + (sep_len if current else 0)
+        current.append(piece)
+    bodies.append(current)
+
+    pages = []
+    for i, body in enumerate(bodies):
+        page = (first_header if i == 0 else header) + separator.join(body) + suffix
+        if i == len(bodies) - 1:
+            page += tail
+        pages.append(page)
+    return pages
+
+
+def money(value):
+    """12345.6 → '12 345,60'"""
+    return f"{value:,.2f}".replace(",", " ").replace(".", ",")
+
+
+@dataclass(frozen=True, eq=False)
+class View:
+    """Готовое сообщение: HTML-текст, клавиатура и отпечаток для сравнения"""
+    text: str
+    markup: InlineKeyboardMarkup
+    digest: int
+
+
+def _view(text, buttons):
+    """buttons — ряды пар (текст кнопки, callback_data)"""
+    markup = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text=label, callback_data=data) for label, data in row]
+        for row in buttons
+    ])
+    digest = hash((text, tuple(tuple(row) for row in buttons)))
+    return View(text=text, markup=markup, digest=digest)
+
+
+_views = LRUStore(maxsize=RENDER_CACHE_SIZE)
+
+
+def _memoized(key, build):
+    view = _views.get(key)
+    if view is None:
+        view = build()
+        _views.put(key, view)
+    return view
+
+
+class DisplayTracker:
+    """Что сейчас показано в сообщениях (по chat_id, message_id). Ограничен по размеру"""
+
+    def __init__(self, maxsize=DISPLAY_TRACKER_SIZE):
+        self._shown = LRUStore(maxsize=maxsize)
+
+    def is_shown(self, chat_id, message_id, view):
+        return self._shown.get((chat_id, message_id)) == view.digest
+
+    def mark(self, chat_id, message_id, view):
+        self._shown.put((chat_id, message_id), view.digest)
+
+
+def error_view(text, retry_data, back_data=None):
+    """Ошибка прямо в сообщении — когда на нажатие уже ответили и всплывающее окно недоступно"""
+    buttons = [[("🔄 Повторить", retry_data)]]
+    if back_data:
+        buttons.append([("🔙 Назад", back_data)])
+    return _view(f"⚠️ {html.escape(text)}", buttons)
+
+
+# ---------- Сводка ----------
+def summary_text(date, total, snapshot, as_of, refreshing, stale):
+    """Текст сводки по снимку касс на 00:00 с пометкой о свежести данных"""
+    total_str = money(total)
+
+    if snapshot is None:
+        # Кэш пуст или не загрузился — это не то же самое, что нулевой баланс
+        marker = "⏳ данные по кассам загружаются" if refreshing else "⚠️ данные по кассам недоступны"
+        return (
+            f"<b>\U0001F4C5 Баланс Экосмотр на {date}</b>\n\n"
+            f"\U0001F4B3 <b>1. Р/с:</b> {total_str} ₽\n"
+            f"\U0001F3E6 <b>2. Кассы Драйв:</b> {marker}\n\n"
+            f"\U0001F9FE <b>Итого:</b> {total_str} ₽ (без касс)"
+        )
+
+    # Последнее обновление не удалось — показываем, на какое время снимок
+    cache_time_str = f"(⚠️ на {as_of.strftime('%H:%M %d.%m.%Y')})" if stale else ""
+
+    return (
+        f"<b>\U0001F4C5 Баланс Экосмотр на {date}</b>\n\n"
+        f"\U0001F4B3 <b>1. Р/с:</b> {total_str} ₽\n"
+        f"\U0001F3E6 <b>2. Кассы Драйв:</b> {money(snapshot.total)} ₽ {cache_time_str}\n\n"
+        f"\U0001F9FE <b>Итого:</b> {money(total + snapshot.total)} ₽"
+    )
+
+
+def summary_view(token, summary):
+    if summary is None:
+        text = "Данные устарели"
+    else:
+        text = summary["text"]
+    return _memoized(("summary", token, text), lambda: _view(text, [
+        [("\U0001F4E8 Подробно счета", callbacks.pack(callbacks.RAW, token))],
+        [("\U0001F4C8 Подробно кассы", callbacks.pack(callbacks.DAILY, token))],
+    ]))
+
+
+# ---------- Постраничные представления ----------
+def _nav_row(page, total_pages, data):
+    """Ряд кнопок ⬅️ n/N ➡️; data(p) — callback_data страницы p"""
+    row = []
+    if page > 1:
+        row.append(("⬅️ Назад", data(page - 1)))
+    row.append((f"{page}/{total_pages}", callbacks.IGNORE))
+    if page < total_pages:
+        row.append(("Вперёд ➡️", data(page + 1)))
+    return row
+
+
+def _paged_view(key, build_pages, page, data, buttons):
+    """Страница page представления key. Страницы режутся один раз на снимок,
+    листание берёт готовые из кэша. Номер страницы приводится к допустимому.
+    """
+    pages = _memoized(("pages", key), build_pages)
+    page = max(1, min(page, len(pages)))
+
+    def build():
+        nav = [_nav_row(page, len(pages), data)] if len(pages) > 1 else []
+        return _view(pages[page - 1], nav + buttons)
+
+    return _memoized((key, page), build)
+
+
+# ---------- Счета из выписки ----------
+def raw_accounts_view(token, summary, page=1):
+    buttons = [
+        [("🔙 Назад", callbacks.pack(callbacks.BACK, token))],
+        [("\U0001F4C8 Кассы", callbacks.pack(callbacks.DAILY, token))],
+    ]
+    if not summary or not summary["entries"]:
+        return _view("Данные устарели", buttons)
+
+    def build_pages():
+        lines = []
+        for name, value in sorted(summary["entries"], key=lambda x: x[1], reverse=True):
+            lines.append(f"▫️ {html.escape(name)}\n{money(value)} ₽\n")
+        return paginate(lines)
+
+    return _paged_view(("raw", token), build_pages, page, lambda p: callbacks.pack(callbacks.RAW, token, p), buttons)
+
+
+# ---------- Кассы ----------
+def _cashbox_lines(rows):
+    lines = []
+    for item in rows:
+        bullet = "▪️" if item["type"] == "org" else "▫️"
+        lines.append(f"{bullet} {html.escape(item['name'])}\n{money(item['balance'])} ₽\n")
+    return lines
+
+
+def cached_cashboxes_view(token, snapshot, as_of, page=1, warming=False):
+    """Кассы из снимка на 00:00. warming — снимок ещё загружается (сразу после старта)"""
+    if snapshot is None or not snapshot.rows:
+        if warming:
+            text = "⏳ Данные по кассам на 00:00 загружаются, нажмите ещё раз через несколько секунд"
+        else:
+            text = "Данные по кассам на 00:00 еще не собраны или отсутствуют"
+        return _memoized(("daily", None, token, warming), lambda: _view(
+            text,
+            [[("🔙 Назад", callbacks.pack(callbacks.BACK, token))]],
+        ))
+
+    def build_pages():
+        # Формируем время обновления
+        time_str = as_of.strftime("%H:%M %d.%m.%Y") if as_of else "время неизвестно"
+        return paginate(
+            _cashbox_lines(snapshot.rows),
+            first_header=f"<b>Данные по кассам (обновлено {time_str})</b>\n\n",
+            tail=f"\n<b>Итого:</b> {money(snapshot.total)} ₽",
+        )
+
+    return _paged_view(("daily", as_of, token), build_pages, page,
+                       lambda p: callbacks.pack(callbacks.DAILY, token, p), [
+                           [("🔄 Актуальные кассы", callbacks.pack(callbacks.LIVE, token))],
+                           [("🔙 Назад", callbacks.pack(callbacks.BACK, token))],
+                       ])
+
+
+def live_cashboxes_view(token, snapshot, as_of, page=1):
+    """Кассы из живого кэша для "Актуальные кассы" """
+    def build_pages():
+        time_str = as_of.strftime("%H:%M:%S %d.%m.%Y")
+        return paginate(_cashbox_lines(snapshot.rows), first_header=f"<b>Кассы на {time_str}</b>\n\n")
+
+    return _paged_view(("live", as_of, token), build_pages, page,
+                       lambda p: callbacks.pack(callbacks.LIVE, token, p), [
+                           [("🔙 Назад", callbacks.pack(callbacks.BACK, token))],
+                           [("\U0001F4C8 Подробно кассы", callbacks.pack(callbacks.DAILY, token))],
+                       ])
+
+
+# ---------- Гос. пошлины ----------
+def taxes_pages(rows):
+    """
+    Возвращает список текстовых 'страниц' с таблицей в <pre>, каждая не длиннее лимита Telegram.
+    Колонки: Код региона | Получатель | Остаток
+    """
+    if not rows:
+        return ["Данных не найдено."]
+
+    headers = ["Код региона", "Получатель", "Остаток"]
+
+    str_rows = []
+    col_widths = [len(h) for h in headers]
+    for r in rows:
+        region_code = str(r.get("Код региона", "") or "")
+        recipient = str(r.get("Получатель", "") or "")
+        count = str(r.get("Остаток", "") or "0")
+
+        row = [region_code, recipient, count]
+        str_rows.append(row)
+        for i, cell in enumerate(row):
+            col_widths[i] = max(col_widths[i], len(cell))
+
+    def fmt_row(cells):
+        return html.escape("  ".join(cell.ljust(col_widths[i]) for i, cell in enumerate(cells)))
+
+    header_line = fmt_row(headers)
+    sep_line = "-" * len(header_line)
+    table_head = f"<pre>\n{header_line}\n{sep_line}\n"
+
+    return paginate(
+        [fmt_row(row) for row in str_rows],
+        first_header=f"<b>Актуальные гос.пошлины по регионам</b>\n{table_head}",
+        header=f"<b>Актуальные гос.пошлины по регионам (продолжение)</b>\n{table_head}",
+        suffix="\n</pre>",
+    )
+
+
+def taxes_view(report, current_page):
+    """Страница отчёта по пошлинам с навигацией; current_page уже в допустимых пределах"""
+    def build():
+        total_pages = len(report["pages"])
+        version = report["version"]
+
+        # Кнопки навигации (предыдущая/следующая)
+        nav_buttons = _nav_row(current_page, total_pages, lambda p: callbacks.pack(callbacks.TAXES, version, p))
+
+        return _view(report["pages"][current_page - 1], [
+            nav_buttons,
+            [("🔄 Обновить", callbacks.REFRESH_TAXES)],
+        ])
+
+    return _memoized(("taxes", report["version"], current_page), build)
@@ -0,0 +1,168 @@
+"""Запросы к таблицам касс и гос. пошлин.
+
+Кассы по организациям и кассы рег./управляющих компаний забираются одним
+запросом (UNION ALL), итоговая сумма считается по тем же строкам — так сводка,
+детализация и кэш всегда показывают согласованные данные.
+"""
+import os
+import time
+import logging
+from dataclasses import dataclass
+from datetime import datetime
+from decimal import Decimal
+
+import pytz
+
+import db
+
+MOSCOW_TZ = pytz.timezone('Europe/Moscow')
+
+CASHBOXES_SQL = """
+    SELECT 'org' AS kind, o.name AS name, SUM(afoc.balance) AS Kassa
+    FROM algon_finance_online_cashbox afoc
+             INNER JOIN oto o ON o.id = afoc.oto_id
+    WHERE afoc.`type` <> "disabled"
+      AND afoc.balance <> 0
+      AND afoc.oto_id IS NOT NULL
+    GROUP BY o.name
+    UNION ALL
+    SELECT 'reg' AS kind, afoc.name AS name, afoc.balance AS Kassa
+    FROM algon_finance_online_cashbox afoc
+    WHERE (afoc.`type` = "reg" OR afoc.`type` = "manage_company")
+      AND afoc.balance <> 0
+    ORDER BY kind, Kassa DESC
+"""
+
+
+@dataclass(frozen=True)
+class CashboxSnapshot:
+    """Снимок остатков: строки {"name", "balance", "type"} и их сумма"""
+    rows: tuple
+    total: Decimal
+    fetched_at: datetime
+
+
+class CashboxRepository:
+    """Единая точка чтения касс для сводки, кэша и детализации"""
+
+    async def fetch(self):
+        """Один запрос к БД. Ошибки БД пробрасываются вызывающему"""
+        rows = []
+        total = Decimal(0)
+        for row in await db.fetch_all(CASHBOXES_SQL, name="cashboxes"):
+            # pymysql отдаёт DECIMAL как Decimal; str() защищает от двоичных хвостов float
+            balance = Decimal(str(row.get("Kassa") or 0))
+            if balance == 0:
+                continue
+            rows.append({
+                "name": (row.get("name") or "").strip(),
+                "balance": balance,
+                "type": row.get("kind") or "org",
+            })
+            total += balance
+
+        return CashboxSnapshot(rows=tuple(rows), total=total, fetched_at=datetime.now(MOSCOW_TZ))
+
+
+cashbox_repository = CashboxRepository()
+
+
+DUTY_SQL = """
+    SELECT dpr.id as 'Id', dpr.region_code as 'Код региона', dpr.recipient_name as 'Получатель', IF(COUNT(t.upno) = 0, 0, COUNT(t.upno)) as 'Остаток'
+    FROM duty_payment_requisites dpr
+             LEFT JOIN webto_user_region_list wurl ON wurl.code = dpr.region_code
+             LEFT JOIN tax t ON t.region_id = wurl.id AND t.active = 1
+    GROUP BY dpr.id, dpr.region_code, dpr.recipient_name
+    ORDER BY COUNT(t.upno) DESC, dpr.region_code
+"""
+
+
+# Инкрементальный режим: справочник регионов маленький и читается всегда,
+# а счётчики по tax пересчитываются, только когда меняется дешёвый «отпечаток» таблицы
+DUTY_REQUISITES_SQL = """
+    SELECT dpr.id, dpr.region_code, dpr.recipient_name, wurl.id AS region_id
+    FROM duty_payment_requisites dpr
+             LEFT JOIN webto_user_region_list wurl ON wurl.code = dpr.region_code
+"""
+
+# Количество и суммы region_id меняются при добавлении, (де)активации и переносе строки
+TAX_FINGERPRINT_SQL = """
+    SELECT COUNT(*) AS total, COUNT(t.upno) AS upno_count,
+           COALESCE(SUM(t.region_id), 0) AS region_sum,
+           COALESCE(SUM(t.region_id * t.region_id), 0) AS region_sq_sum
+    FROM tax t
+    WHERE t.active = 1
+"""
+
+TAX_COUNTS_SQL = """
+    SELECT t.region_id, COUNT(t.upno) AS cnt
+    FROM tax t
+    WHERE t.active = 1
+    GROUP BY t.region_id
+"""
+
+DUTY_INCREMENTAL = os.getenv("DUTY_INCREMENTAL", "1") != "0"
+# Страховочный полный пересчёт, даже если отпечаток не изменился
+DUTY_FULL_RECOUNT_SECONDS = float(os.getenv("DUTY_FULL_RECOUNT_SECONDS", 3600) or 3600)
+
+
+class DutyRepository:
+    """Остатки гос. пошлин по регионам.
+
+    В инкрементальном режиме счётчики по регионам держатся в памяти, и при
+    обновлении сначала сверяется отпечаток активных строк tax. Если он не
+    изменился, группировка по tax не выполняется вовсе.
+    """
+
+    def __init__(self, incremental=DUTY_INCREMENTAL, full_recount_seconds=DUTY_FULL_RECOUNT_SECONDS):
+        self.incremental = incremental
+        self.full_recount_seconds = full_recount_seconds
+        self._counts = None  # region_id -> количество активных пошлин
+        self._fingerprint = None
+        self._counted_at = 0.0
+
+    async def fetch(self):
+        """Строки отчёта в формате DUTY_SQL. Ошибки БД пробрасываются вызывающему"""
+        if not self.incremental:
+            return await db.fetch_all(DUTY_SQL, name="duty")
+
+        requisites = await db.fetch_all(DUTY_REQUISITES_SQL, name="duty_requisites")
+        await self._refresh_counts()
+        return self._build_rows(requisites)
+
+    async def _refresh_counts(self):
+        row = await db.fetch_one(TAX_FINGERPRINT_SQL, name="tax_fingerprint") or {}
+        fingerprint = tuple(str(row.get(k)) for k in ("total", "upno_count", "region_sum", "region_sq_sum"))
+
+        expired = time.monotonic() - self._counted_at > self.full_recount_seconds
+        if self._counts is not None and fingerprint == self._fingerprint and not expired:
+            logging.debug("Таблица tax не изменилась, пересчёт пошлин пропущен")
+            return
+
+        rows = await db.fetch_all(TAX_COUNTS_SQL, name="tax_counts")
+        self._counts = {r["region_id"]: int(r["cnt"] or 0) for r in rows}
+        self._fingerprint = fingerprint
+        self._counted_at = time.monotonic()
+        logging.info("Пересчитаны остатки пошлин по %s регионам", len(self._counts))
+
+    def _build_rows(self, requisites):
+        # У одного кода региона может быть несколько записей в webto_user_region_list
+        by_id = {}
+        for r in requisites:
+            item = by_id.get(r["id"])
+            if item is None:
+                item = by_id[r["id"]] = {
+                    "Id": r["id"],
+                    "Код региона": r["region_code"],
+                    "Получатель": r["recipient_name"],
+                    "Остаток": 0,
+                }
+            if r["region_id"] is not None:
+                item["Остаток"] += self._counts.get(r["region_id"], 0)
+
+        rows = list(by_id.values())
+        rows.sort(key=lambda x: (-x["Остаток"], str(x["Код региона"] or "")))
+        return rows
+
+
+duty_repository = DutyRepository()
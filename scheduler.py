@@ -0,0 +1,207 @@
+"""Планировщик фоновых задач с расписанием в формате cron.
+
+Каждая задача — корутина без аргументов и строка расписания из пяти полей
+("минуты часы день месяц день_недели", например "50 8 * * 1-5"), которая
+считается в часовом поясе SCHEDULER_TZ. У задачи есть:
+
+- jitter — случайная задержка до N секунд, чтобы процессы не били в БД одновременно;
+- timeout — зависшая задача отменяется, следующий запуск идёт по расписанию;
+- retry — через сколько секунд повторить после ошибки (но не позже следующего запуска);
+- catch_up — если запуск пропущен (процесс был остановлен), он выполняется сразу
+  после старта. Время последнего запуска хранится в SQLite (store.SnapshotDB).
+
+Запуски одной задачи никогда не перекрываются: следующий считается от момента
+окончания предыдущего, а пропущенные за время долгого выполнения не копятся.
+"""
+import os
+import time
+import random
+import asyncio
+import logging
+import traceback
+from datetime import datetime, timedelta
+
+import pytz
+
+import logs
+import metrics
+
+SCHEDULER_TZ = os.getenv("SCHEDULER_TZ", "Europe/Moscow")
+# Длинный сон режется на куски: после паузы процесса или перевода часов расписание сверяется заново
+MAX_SLEEP = 60
+
+_FIELDS = (
+    ("минуты", 0, 59),
+    ("часы", 0, 23),
+    ("день месяца", 1, 31),
+    ("месяц", 1, 12),
+    ("день недели", 0, 7),  # 0 и 7 — воскресенье
+)
+
+
+def _parse_field(text, name, low, high):
+    values = set()
+    for part in text.split(","):
+        step = 1
+        if "/" in part:
+            part, step_text = part.split("/", 1)
+            step = int(step_text)
+            if step < 1:
+                raise ValueError(f"Шаг в поле «{name}» должен быть положительным: {text!r}")
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start, end = (int(x) for x in part.split("-", 1))
+        else:
+            start = int(part)
+            end = high if step > 1 else start
+        if not low <= start <= end <= high:
+            raise ValueError(f"Поле «{name}» вне диапазона {low}-{high}: {text!r}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class Cron:
+    """Расписание в формате cron: минуты, часы, день месяца, месяц, день недели"""
+
+    def __init__(self, expr):
+        parts = expr.split()
+        if len(parts) != 5:
+            raise ValueError(f"В расписании должно быть 5 полей, получено {len(parts)}: {expr!r}")
+        self.expr = expr
+        (self.minutes, self.hours, self.days, self.months, weekdays) = (
+            _parse_field(text, *field) for text, field in zip(parts, _FIELDS)
+        )
+        self.weekdays = {d % 7 for d in weekdays}
+        # Как в cron: если заданы оба дня, подходит любой из них
+        self._any_day = parts[2] == "*"
+        self._any_weekday = parts[4] == "*"
+
+    def _day_matches(self, moment):
+        weekday = (moment.weekday() + 1) % 7  # в cron неделя начинается с воскресенья
+        if self._any_day or self._any_weekday:
+            return moment.day in self.days and weekday in self.weekdays
+        return moment.day in self.days or weekday in self.weekdays
+
+    def next_after(self, moment):
+        """Ближайший момент строго после moment (aware datetime) в его часовом поясе"""
+        tz = moment.tzinfo
+        t = moment.replace(tzinfo=None, second=0, microsecond=0) + timedelta(minutes=1)
+        limit = t + timedelta(days=366 * 5)
+        while t < limit:
+            if t.month not in self.months:
+                t = (t.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(t):
+                t = t.replace(hour=0, minute=0) + timedelta(days=1)
+            elif t.hour not in self.hours:
+                t = t.replace(minute=0) + timedelta(hours=1)
+            elif t.minute not in self.minutes:
+                t += timedelta(minutes=1)
+            else:
+                return tz.localize(t) if hasattr(tz, "localize") else t.replace(tzinfo=tz)
+        raise ValueError(f"Расписание {self.expr!r} не срабатывает ни разу за 5 лет")
+
+
+class Job:
+    def __init__(self, name, func, schedule, timeout=None, jitter=0.0, retry=None, catch_up=False):
+        self.name = name
+        self.func = func
+        self.cron = Cron(schedule)
+        self.timeout = timeout
+        self.jitter = jitter
+        self.retry = retry
+        self.catch_up = catch_up
+        self.last_run = None
+
+
+class Scheduler:
+    """Набор задач, каждая крутится в своём цикле на текущем event loop.
+
+    store — объект с load_job_run(name) / save_job_run(name, at), например
+    SnapshotDB; без него догоняющие запуски после рестарта не работают.
+    """
+
+    def __init__(self, store=None, tz=SCHEDULER_TZ):
+        self.store = store
+        self.tz = pytz.timezone(tz)
+        self.jobs = []
+
+    def add(self, name, func, schedule, **options):
+        job = Job(name, func, schedule, **options)
+        self.jobs.append(job)
+        return job
+
+    async def run(self):
+        await asyncio.gather(*(self._loop(job) for job in self.jobs))
+
+    def _now(self):
+        return datetime.now(self.tz)
+
+    async def _sleep_until(self, moment):
+        while True:
+            delay = (moment - self._now()).total_seconds()
+            if delay <= 0:
+                return
+            await asyncio.sleep(min(delay, MAX_SLEEP))
+
+    async def _first_run(self, job):
+        """Первый запуск после старта: сразу, если по расписанию он был пропущен"""
+        now = self._now()
+        if job.catch_up and self.store is not None:
+            try:
+                job.last_run = await self.store.load_job_run(job.name)
+            except Exception as e:
+                logging.error("Не удалось прочитать время запуска задачи %s: %s", job.name, e)
+            if job.last_run is not None and job.cron.next_after(job.last_run) <= now:
+                logging.info("Задача %s пропустила запуск (последний — %s), выполняю сейчас",
+                             job.name, job.last_run.strftime('%H:%M %d.%m.%Y'))
+                return now
+        return job.cron.next_after(now)
+
+    async def _loop(self, job):
+        next_run = await self._first_run(job)
+        log = logging.info  # время первого запуска — в INFO, дальше в DEBUG: частые задачи не засоряют лог
+        while True:
+            if next_run > self._now():
+                log("Задача %s: следующий запуск в %s", job.name, next_run.strftime('%H:%M:%S %d.%m.%Y'))
+                log = logging.debug
+                await self._sleep_until(next_run)
+                if job.jitter:
+                    await asyncio.sleep(random.uniform(0, job.jitter))
+
+            ok = await self._execute(job)
+            next_run = job.cron.next_after(self._now())
+            if not ok and job.retry:
+                next_run = min(next_run, self._now() + timedelta(seconds=job.retry))
+
+    async def _execute(self, job):
+        """Один запуск с таймаутом. Возвращает True при успехе; ошибки только логируются"""
+        started_at = self._now()
+        start = time.perf_counter()
+        result = "ok"
+        with logs.correlation(f"job-{job.name}"):
+            try:
+                await asyncio.wait_for(job.func(), job.timeout)
+            except asyncio.TimeoutError:
+                result = "timeout"
+                logging.error("Задача %s не уложилась в %s с и отменена", job.name, job.timeout)
+            except Exception as e:
+                result = "error"
+                logging.error("Ошибка в задаче %s: %s", job.name, e)
+                logging.error(traceback.format_exc())
+
+        seconds = time.perf_counter() - start
+        metrics.JOB_RUNS.inc(job=job.name, result=result)
+        metrics.JOB_SECONDS.observe(seconds, job=job.name)
+        if result != "ok":
+            return False
+
+        metrics.JOB_LAST_SUCCESS.set(time.time(), job=job.name)
+        logging.debug("Задача %s выполнена за %.3f с", job.name, seconds)
+        job.last_run = started_at
+        if job.catch_up and self.store is not None:
+            try:
+                await self.store.save_job_run(job.name, started_at)
+            except Exception as e:
+                logging.error("Не удалось сохранить время запуска задачи %s: %s", job.name, e)
+        return True
@@ -0,0 +1,97 @@
+"""Разбор финансовых сообщений вида ^Название$12345.67$.
+
+Шаблон компилируется один раз при импорте, строки разбираются за один проход,
+суммы считаются в Decimal, чтобы копейки не терялись на длинных выписках.
+Поддерживаются разделители разрядов (пробел, NBSP, узкие пробелы, точки или
+запятые группами по три цифры), десятичная запятая или точка, минус в начале
+или в конце и знак ₽. Неоднозначная запись (1.234.56) не считается числом.
+"""
+import re
+from decimal import Decimal, InvalidOperation
+
+# Обычная сумма (цифры, пробелы/NBSP между разрядами, одна десятичная запятая или точка)
+# проверяется самим шаблоном и попадает во вторую группу, всё остальное — в третью
+ENTRY_RE = re.compile(r"^\^(.+?)\$(?:(-?\d[\d \xa0]*(?:[.,]\d+)?)|([^$\n]+))\$", re.MULTILINE)
+
+# Частый случай после удаления пробелов: 1234567,89 / -1234.5
+_PLAIN_RE = re.compile(r"-?\d+(?:[.,]\d+)?")
+_AMOUNT_RE = re.compile(r"\d+(?:\.\d+)?")
+# Только разделители разрядов: 1.234.567 / 1,234,567
+_GROUPED_RE = re.compile(r"\d{1,3}(?:([.,])\d{3})(?:\1\d{3})*")
+
+
+def _strip_separators(raw):
+    # Цепочка replace заметно быстрее str.translate с удалением символов
+    return (
+        raw.replace(" ", "").replace("\xa0", "").replace("\u202f", "")
+        .replace("\u2009", "").replace("\u2007", "").replace("\t", "").replace("'", "")
+    )
+
+
+def _normalize_separators(value):
+    """Несколько точек/запятых: 1.234.567,89 и 1,234,567.89 — последний знак десятичный,
+    1.234.567 и 1,234,567 — только разряды. Для неоднозначной записи — None"""
+    if _GROUPED_RE.fullmatch(value):
+        return value.replace(".", "").replace(",", "")
+
+    point = max(value.rfind("."), value.rfind(","))
+    head, tail = value[:point], value[point + 1:]
+    thousands = "," if value[point] == "." else "."
+    # Десятичный знак встречается один раз, в целой части — разряды другим знаком по три цифры
+    if value[point] in head or not _GROUPED_RE.fullmatch(head) or thousands not in head:
+        return None
+    return head.replace(thousands, "") + "." + tail
+
+
+def parse_amount(raw):
+    """Переводит строку суммы в Decimal. Возвращает None, если это не число"""
+    value = _strip_separators(raw)
+    if _PLAIN_RE.fullmatch(value):
+        return Decimal(value.replace(",", "."))
+
+    value = value.replace("₽", "").replace("\u2212", "-")
+    if value.lower().endswith("руб"):
+        value = value[:-3]
+
+    negative = False
+    if value.endswith("-"):
+        negative, value = True, value[:-1]
+    if value.startswith("-"):
+        negative, value = not negative, value[1:]
+
+    if value.count(".") + value.count(",") > 1:
+        value = _normalize_separators(value)
+        if value is None:
+            return None
+    else:
+        value = value.replace(",", ".")
+
+    if not _AMOUNT_RE.fullmatch(value):
+        return None
+    try:
+        amount = Decimal(value)
+    except InvalidOperation:
+        return None
+    return -amount if negative else amount
+
+
+def parse_statement(text):
+    """Возвращает (строки в порядке сообщения, итог в Decimal).
+
+    Сортировка по сумме нужна только для детализации, поэтому она делается
+    при показе, а не на каждое входящее сообщение.
+    """
+    entries = []
+    total = Decimal(0)
+    for match in ENTRY_RE.finditer(text):
+        name, plain, raw = match.groups()
+        # Быстрый путь: формат уже проверен шаблоном. Полный разбор — только для остальных
+        if plain:
+            amount = Decimal(plain.replace("\xa0", "").replace(" ", "").replace(",", "."))
+        else:
+            amount = parse_amount(raw)
+            if amount is None:
+                continue
+        entries.append((name.strip(), amount))
+        total += amount
+    return entries, total
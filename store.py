@@ -0,0 +1,192 @@
+"""Снимки данных, привязанные к отправленным сводкам.
+
+Каждая сводка получает короткий токен, который зашивается в callback_data её
+кнопок. По токену кнопки находят свой снимок (строки выписки, текст сводки),
+поэтому старое сообщение не показывает данные более нового. В памяти
+хранилище ограничено по размеру и вытесняет давно не использованные снимки,
+а SnapshotDB дублирует их на диск, чтобы кнопки переживали перезапуск.
+"""
+import os
+import json
+import time
+import asyncio
+import sqlite3
+import secrets
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from decimal import Decimal
+
+from repository import CashboxSnapshot
+
+SNAPSHOT_STORE_SIZE = int(os.getenv("SNAPSHOT_STORE_SIZE", 200) or 200)
+
+
+def new_token():
+    """Короткий токен для callback_data (8 символов base64url, без ':')"""
+    return secrets.token_urlsafe(6)
+
+
+class LRUStore:
+    """Словарь ограниченного размера с вытеснением по давности использования. O(1) на операцию"""
+
+    def __init__(self, maxsize=SNAPSHOT_STORE_SIZE):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            self._data.move_to_end(key)
+        except KeyError:
+            return default
+        return self._data[key]
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+
+SNAPSHOT_DB_PATH = os.getenv("SNAPSHOT_DB_PATH", "data/snapshots.sqlite3")
+SNAPSHOT_RETENTION_DAYS = float(os.getenv("SNAPSHOT_RETENTION_DAYS", 30) or 30)
+
+
+def _dump_summary(summary):
+    return json.dumps({
+        "text": summary["text"],
+        "entries": [[name, str(amount)] for name, amount in summary["entries"]],
+        "total": str(summary["total"]),
+        "date": summary["date"],
+    }, ensure_ascii=False)
+
+
+def _load_summary(raw, version=1):
+    data = json.loads(raw)
+    data["version"] = version
+    data["entries"] = [(name, Decimal(amount)) for name, amount in data["entries"]]
+    data["total"] = Decimal(data["total"])
+    return data
+
+
+def _dump_cashboxes(snapshot):
+    return json.dumps({
+        "rows": [{**row, "balance": str(row["balance"])} for row in snapshot.rows],
+        "total": str(snapshot.total),
+        "fetched_at": snapshot.fetched_at.isoformat(),
+    }, ensure_ascii=False)
+
+
+def _load_cashboxes(raw):
+    data = json.loads(raw)
+    return CashboxSnapshot(
+        rows=tuple({**row, "balance": Decimal(row["balance"])} for row in data["rows"]),
+        total=Decimal(data["total"]),
+        fetched_at=datetime.fromisoformat(data["fetched_at"]),
+    )
+
+
+class SnapshotDB:
+    """Снимки на диске (SQLite): сводки по токену и последние снимки касс.
+
+    Нужны, чтобы после перезапуска контейнера старые кнопки продолжали
+    работать, а сводка сразу получала кассы. Все обращения к файлу идут через
+    один выделенный поток — event loop не ждёт диск.
+    """
+
+    def __init__(self, path=SNAPSHOT_DB_PATH):
+        self.path = path
+        self._conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+
+    def _connection(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS summaries "
+                "(token TEXT PRIMARY KEY, created_at REAL, data TEXT, version INTEGER NOT NULL DEFAULT 1)"
+            )
+            # Файлы, созданные до появления версий сводок
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(summaries)")}
+            if "version" not in columns:
+                self._conn.execute("ALTER TABLE summaries ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cashboxes (name TEXT PRIMARY KEY, as_of TEXT, data TEXT)"
+            )
+            self._conn.execute("CREATE TABLE IF NOT EXISTS jobs (name TEXT PRIMARY KEY, last_run TEXT)")
+            self._conn.commit()
+        return self._conn
+
+    def _write(self, sql, args):
+        conn = self._connection()
+        conn.execute(sql, args)
+        conn.commit()
+
+    def _read(self, sql, args):
+        return self._connection().execute(sql, args).fetchone()
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def save_summary(self, token, summary):
+        await self._run(
+            self._write,
+            "INSERT OR REPLACE INTO summaries (token, created_at, data, version) VALUES (?, ?, ?, ?)",
+            (token, time.time(), _dump_summary(summary), summary.get("version", 1)),
+        )
+
+    async def load_summary(self, token):
+        row = await self._run(self._read, "SELECT data, version FROM summaries WHERE token = ?", (token,))
+        return _load_summary(*row) if row else None
+
+    async def load_summary_version(self, token):
+        """Версия сводки без чтения строк: растёт, когда сводку правят после обновления касс"""
+        row = await self._run(self._read, "SELECT version FROM summaries WHERE token = ?", (token,))
+        return row[0] if row else None
+
+    async def save_cashboxes(self, name, snapshot, as_of):
+        await self._run(
+            self._write,
+            "INSERT OR REPLACE INTO cashboxes (name, as_of, data) VALUES (?, ?, ?)",
+            (name, as_of.isoformat(), _dump_cashboxes(snapshot)),
+        )
+
+    async def load_cashboxes(self, name):
+        """Возвращает (снимок, время актуальности) или (None, None)"""
+        row = await self._run(self._read, "SELECT data, as_of FROM cashboxes WHERE name = ?", (name,))
+        if not row:
+            return None, None
+        return _load_cashboxes(row[0]), datetime.fromisoformat(row[1])
+
+    async def save_job_run(self, name, at):
+        """Время последнего запуска задачи планировщика — для догоняющего запуска после рестарта"""
+        await self._run(self._write, "INSERT OR REPLACE INTO jobs (name, last_run) VALUES (?, ?)",
+                        (name, at.isoformat()))
+
+    async def load_job_run(self, name):
+        row = await self._run(self._read, "SELECT last_run FROM jobs WHERE name = ?", (name,))
+        return datetime.fromisoformat(row[0]) if row else None
+
+    async def prune(self, max_age_days=SNAPSHOT_RETENTION_DAYS):
+        """Удаляет сводки старше max_age_days"""
+        await self._run(
+            self._write,
+            "DELETE FROM summaries WHERE created_at < ?",
+            (time.time() - max_age_days * 86400,),
+        )
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        if self._conn is not None:
+            self._conn.close()
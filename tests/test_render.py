@@ -0,0 +1,69 @@
+import re
+import random
+
+import pytest
+
+from render import _split_html, paginate, utf16_len
+
+_TAG_RE = re.compile(r"<(/?)(\w+)[^>]*>")
+
+
+def _balanced(page):
+    stack = []
+    for closing, name in _TAG_RE.findall(page):
+        if not closing:
+            stack.append(name)
+        elif not stack or stack.pop() != name:
+            return False
+    return not stack
+
+
+def _text(html):
+    return _TAG_RE.sub("", html)
+
+
+def _random_block(rng):
+    parts = []
+    for _ in range(rng.randint(1, 12)):
+        text = "".join(rng.choice("ab цд💰&") for _ in range(rng.randint(0, 40)))
+        text = text.replace("&", "&amp;")
+        tag = rng.choice([None, "b", "i", "code", 'a href="https://example.com"'])
+        if tag is None:
+            parts.append(text)
+        else:
+            name = tag.split()[0]
+            inner = f"<b>{text}</b>" if name == "i" and rng.random() < 0.5 else text
+            parts.append(f"<{tag}>{inner}</{name}>")
+    return "".join(parts)
+
+
+def test_split_html_reserves_closing_tag():
+    chunks = _split_html("a" * 10 + "<b>" + "c" * 20 + "</b>", 14)
+    assert all(utf16_len(chunk) <= 14 for chunk in chunks)
+    assert all(_balanced(chunk) for chunk in chunks)
+    assert "<b></b>" not in "".join(chunks)
+    assert _text("".join(chunks)) == "a" * 10 + "c" * 20
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_split_html_fuzz(seed):
+    rng = random.Random(seed)
+    block = _random_block(rng)
+    budget = rng.randint(60, 160)  # не меньше самой длинной пары тегов с одним символом
+    chunks = _split_html(block, budget)
+    assert all(utf16_len(chunk) <= budget for chunk in chunks)
+    assert all(_balanced(chunk) for chunk in chunks)
+    assert not any(re.search(r"<(\w+)[^>]*></\1>", chunk) for chunk in chunks)
+    assert _text("".join(chunks)) == _text(block)
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_paginate_fits_limit(seed):
+    rng = random.Random(seed)
+    blocks = [_random_block(rng) for _ in range(rng.randint(1, 30))]
+    limit = rng.randint(150, 400)
+    pages = paginate(blocks, first_header="<b>Заголовок</b>", header="<i>Продолжение</i>",
+                     suffix="\n", tail="<code>конец</code>", limit=limit)
+    assert pages
+    assert all(utf16_len(page) <= limit for page in pages)
+    assert all(_balanced(page) for page in pages)
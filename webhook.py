@@ -0,0 +1,51 @@
+"""Приём обновлений бота через webhook вместо long polling.
+
+Включается BOT_MODE=webhook. aiohttp-сервер поднимается на том же event loop,
+что Telethon и кэши; Telegram присылает обновления на WEBHOOK_PATH с
+заголовком X-Telegram-Bot-Api-Secret-Token, запросы без верного секрета
+отклоняются. Если задан WEBHOOK_URL, адрес регистрируется в Telegram при
+старте; без него сервер можно проверить локально, отправляя записанные
+обновления curl'ом.
+"""
+import os
+import logging
+
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")  # публичный адрес, например https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8080) or 8080)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+
+
+def enabled():
+    return BOT_MODE == "webhook"
+
+
+async def start(dp, bot, allowed_updates):
+    """Поднимает сервер webhook и (если задан WEBHOOK_URL) регистрирует его в Telegram"""
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("Для BOT_MODE=webhook нужен WEBHOOK_SECRET (1-256 символов A-Z, a-z, 0-9, _ и -)")
+
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    logging.info("Webhook слушает http://%s:%s%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            url=WEBHOOK_URL + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=allowed_updates,
+        )
+        logging.info("Webhook зарегистрирован в Telegram: %s%s", WEBHOOK_URL, WEBHOOK_PATH)
+    else:
+        logging.warning("WEBHOOK_URL не задан: webhook в Telegram не регистрируется (локальный режим)")
+    return runner
@@ -1,14 +1,18 @@
-import re
 import asyncio
+import argparse
 import os
 import logging
 import traceback
 import contextlib
 import sys
-import html
-from datetime import datetime, time, timedelta
+from time import monotonic
+from datetime import datetime
+from decimal import Decimal
 import pytz  # Добавляем pytz для работы с часовыми поясами
 
+# Точка отсчёта worker_startup_seconds: до импорта aiogram и Telethon, они занимают заметную часть старта
+PROCESS_STARTED = monotonic()
+
 from telethon import TelegramClient, events
 from aiogram import Bot, Dispatcher
 from aiogram.enums import ParseMode
@@ -18,605 +22,569 @@ from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
 
 from dotenv import load_dotenv
-import pymysql
-from pymysql import Error as PyMysqlError
 
 from telethon.sessions import StringSession
 
 load_dotenv()
 
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+import db  # noqa: E402  — читает настройки из окружения, поэтому после load_dotenv()
+from repository import cashbox_repository, duty_repository  # noqa: E402
+from cache import SWRCache  # noqa: E402
+from delivery import Broadcaster, parse_chat_ids  # noqa: E402
+from statement_parser import parse_statement  # noqa: E402
+from store import LRUStore, SnapshotDB, new_token  # noqa: E402
+import render  # noqa: E402
+import callbacks  # noqa: E402
+import metrics  # noqa: E402
+import loop_watchdog  # noqa: E402
+import logs  # noqa: E402
+from ingestion import IngestQueue  # noqa: E402
+from scheduler import Scheduler  # noqa: E402
+import webhook  # noqa: E402
+
+# Сколько секунд данные для кнопки "Актуальные кассы" считаются свежими
+CASHBOX_CACHE_TTL = float(os.getenv("CASHBOX_CACHE_TTL", 60) or 60)
+# Как часто процессы ingest и bot перечитывают снимок касс, записанный процессом scheduler
+SHARED_SNAPSHOT_POLL_SECONDS = float(os.getenv("SHARED_SNAPSHOT_POLL_SECONDS", 30) or 30)
+# Сколько секунд отчёт по гос. пошлинам отдаётся из памяти без запроса к БД
+DUTY_CACHE_TTL = float(os.getenv("DUTY_CACHE_TTL", 300) or 300)
+
+# Расписания (cron, часовой пояс SCHEDULER_TZ): снимок касс на 00:00, прогрев кэшей
+# перед началом рабочего дня и чистка старых сводок на диске
+CASHBOX_SCHEDULE = os.getenv("CASHBOX_SCHEDULE", "0 0 * * *")
+PREWARM_SCHEDULE = os.getenv("PREWARM_SCHEDULE", "50 8 * * 1-5")
+SNAPSHOT_PRUNE_SCHEDULE = os.getenv("SNAPSHOT_PRUNE_SCHEDULE", "30 3 * * *")
+METRICS_FLUSH_SCHEDULE = os.getenv("METRICS_FLUSH_SCHEDULE", "* * * * *")
+
+ALLOWED_UPDATES = ["message", "callback_query"]
+
+# Учётные данные и клиенты заполняет setup(): импорт модуля не требует ключей,
+# а процессам bot и scheduler TG_SESSION не нужен вовсе
+bot = None
+client = None
+target_chat_id = None
+summary_chat_ids = []
+ALLOWED_START_IDS = set()
+# Источники финансовых сообщений: ID или @username через запятую. Пусто — слушаем все диалоги
+SOURCE_CHATS = []
+SOURCE_SENDERS = []
+# Роль bot: сводки правит процесс ingest, копию в памяти сверяем с диском по версии
+SHARED_SUMMARIES = False
 
-# Добавляем глобальные переменные для кэша данных по кассам
-cached_cashboxes_data = []  # Будет хранить данные, полученные в 00:00
-cached_cashboxes_timestamp = None  # Время последнего обновления кэша
-cashboxes_cache_lock = asyncio.Lock()  # Блокировка для безопасного доступа к кэшу
+dp = Dispatcher()
+# Колбэки замеряются в callbacks.Router, сообщения — здесь
+dp.message.middleware(loop_watchdog.TracingMiddleware())
 
-api_id = int(os.getenv("TG_API_ID"))
-api_hash = os.getenv("TG_API_HASH")
-bot_token = os.getenv("BOT_TOKEN")
+broadcaster = Broadcaster()
 
-ALLOWED_START_IDS = set(
-    int(x.strip()) for x in os.getenv("ALLOWED_START_IDS").split(",") if x.strip()
-)
+# Снимки сводок по токену из callback_data: текст для "Назад" и строки для "Подробно счета".
+# В памяти — последние SNAPSHOT_STORE_SIZE, на диске — все за SNAPSHOT_RETENTION_DAYS
+summaries = LRUStore()
+snapshot_db = SnapshotDB()
+# Что уже показано в каждом сообщении — одинаковое содержимое повторно не редактируем
+displayed = render.DisplayTracker()
 
-bot = Bot(token=bot_token, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher()
 
-target_chat_id = int(os.getenv("OWNER_CHAT_ID"))
-_owner_d = os.getenv("OWNER_CHAT_ID_D")
-_owner_n = os.getenv("OWNER_CHAT_ID_N")
-_owner_f = os.getenv("OWNER_CHAT_ID_FINDIR")
-_owner_ff = os.getenv("OWNER_CHAT_ID_FINANCE")
-target_chat_id_D = int(_owner_d) if (_owner_d and _owner_d.isdigit()) else target_chat_id
-target_chat_id_N = int(_owner_n) if (_owner_n and _owner_n.isdigit()) else target_chat_id
-target_chat_id_F = int(_owner_f) if (_owner_f and _owner_f.isdigit()) else target_chat_id
-target_chat_id_FF = int(_owner_ff) if (_owner_ff and _owner_ff.isdigit()) else target_chat_id
+def _env_list(name):
+    return [x.strip() for x in os.getenv(name, "").split(",") if x.strip()]
 
-session_str = os.getenv("TG_SESSION")
-if not session_str:
-    raise RuntimeError("Нет TG_SESSION. Сгенерируйте StringSession и положите в .env")
-client = TelegramClient(StringSession(session_str), api_id, api_hash)
 
-# Кэш последних данных для кнопки "Подробно счета"
-parsed_data = []
+def setup(role="all"):
+    """Читает настройки из окружения и создаёт клиентов Bot API и Telethon, нужных роли.
 
-# Текст последнего сводного сообщения для "Назад"
-last_summary_text = ""
+    Соединения здесь не открываются: подключением занимается main(), параллельно для всех компонентов.
+    """
+    global bot, client, target_chat_id, summary_chat_ids, ALLOWED_START_IDS, SOURCE_CHATS, SOURCE_SENDERS
+    global SHARED_SUMMARIES
+
+    target_chat_id = int(os.getenv("OWNER_CHAT_ID"))
+    # Получатели сводки: владелец, старые OWNER_CHAT_ID_* и любой список из SUMMARY_CHAT_IDS
+    summary_chat_ids = parse_chat_ids(
+        os.getenv("OWNER_CHAT_ID"),
+        os.getenv("OWNER_CHAT_ID_D"),
+        os.getenv("OWNER_CHAT_ID_N"),
+        os.getenv("OWNER_CHAT_ID_FINDIR"),
+        os.getenv("OWNER_CHAT_ID_FINANCE"),
+        os.getenv("SUMMARY_CHAT_IDS"),
+    )
+    ALLOWED_START_IDS = set(int(x) for x in _env_list("ALLOWED_START_IDS"))
+    SOURCE_CHATS = _env_list("SOURCE_CHATS")
+    SOURCE_SENDERS = _env_list("SOURCE_SENDERS")
+    SHARED_SUMMARIES = role == "bot"
+
+    if role != "scheduler":
+        bot = Bot(token=os.getenv("BOT_TOKEN"), default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+        bot.session.middleware(metrics.TelegramMetricsMiddleware())
+
+    if role in ("all", "ingest"):
+        session_str = os.getenv("TG_SESSION")
+        if not session_str:
+            raise RuntimeError("Нет TG_SESSION. Сгенерируйте StringSession и положите в .env")
+        client = TelegramClient(StringSession(session_str), int(os.getenv("TG_API_ID")), os.getenv("TG_API_HASH"))
+
+
+# ---------- Готовность ----------
+# Компоненты, без которых роль ещё не готова. Время до готовности каждого — в worker_startup_seconds
+ROLE_COMPONENTS = {
+    "all": ("cashboxes", "telethon", "bot"),
+    "ingest": ("cashboxes", "telethon"),
+    "bot": ("cashboxes", "bot"),
+    "scheduler": ("cashboxes",),
+}
+_startup_pending = set()
+
+
+def _mark_ready(component):
+    if component not in _startup_pending:
+        return
+    _startup_pending.discard(component)
+    seconds = monotonic() - PROCESS_STARTED
+    metrics.STARTUP_SECONDS.set(seconds, component=component)
+    logging.info("Готово: %s через %.3f с после запуска", component, seconds)
+    if not _startup_pending:
+        metrics.STARTUP_SECONDS.set(seconds, component="ready")
+        logging.info("Воркер готов через %.3f с после запуска", seconds)
 
 
-# ---------- Работа с БД ----------
-def _db_params():
-    return {
-        "user": os.getenv("DB_USER"),
-        "password": os.getenv("DB_PASS"),
-        "host": os.getenv("DB_HOST"),
-        "port": int(os.getenv("DB_PORT", 3366) or 3366),
-        "database": os.getenv("DB_NAME"),
-        "charset": 'utf8mb4',
-    }
-
-
-async def obrabotchik():
-    """Возвращает сумму по кассам. Безопасно: при любой ошибке вернёт 0.0"""
-    logging.debug("Запуск obrabotchik()")
-    params = _db_params()
-    conn = None
-    try:
-        if any(v in (None, "") for v in params.values()):
-            logging.error("Параметры подключения к БД неполные")
-            return 0.0
-
-        conn = pymysql.connect(**params, cursorclass=pymysql.cursors.DictCursor)
-        logging.debug("Успешное подключение к БД")
-
-        with conn.cursor() as cur:
-            logging.debug("Выполнение SQL-запроса для суммы кассы")
-            cur.execute(
-                """
-                SELECT SUM(afoc.balance) AS total_balance
-                FROM algon_finance_online_cashbox afoc
-                WHERE afoc.type <> "disabled"
-                """
-            )
-            row = cur.fetchone() or {}
-            kassa = row.get("total_balance")
-            return float(kassa or 0.0)
-    except PyMysqlError as e:
-        logging.error(f"Ошибка подключения/запроса к БД: {e}")
-        logging.error(traceback.format_exc())
-        return 0.0
-    except Exception as e:
-        logging.error(f"Ошибка в obrabotchik(): {e}")
-        logging.error(traceback.format_exc())
-        return 0.0
-    finally:
-        with contextlib.suppress(Exception):
-            if conn:
-                conn.close()
+def _cashboxes_warming():
+    """Снимок касс ещё поднимается с диска или грузится из БД"""
+    return "cashboxes" in _startup_pending or daily_cashboxes.is_refreshing()
 
 
+# ---------- Работа с БД ----------
 async def fetch_cashboxes_data():
-    """Получает данные по кассам из БД для кэширования"""
+    """Загрузчик для кэшей касс: снимок из БД. Ошибки обрабатывает кэш, сохраняя старый снимок"""
     logging.info("Получение данных по кассам для кэша")
-    params = _db_params()
-    conn = None
-    try:
-        if any(v in (None, "") for v in params.values()):
-            logging.error("Параметры подключения к БД неполные")
-            return []
-
-        conn = pymysql.connect(**params, cursorclass=pymysql.cursors.DictCursor)
-
-        with conn.cursor() as cur:
-            # Запрос 1: кассы по организациям
-            cur.execute(
-                """
-                SELECT o.name, SUM(afoc.balance) as Kassa
-                FROM algon_finance_online_cashbox afoc
-                         INNER JOIN oto o ON o.id = afoc.oto_id
-                WHERE afoc.`type` <> "disabled"
-                  AND afoc.balance <> 0
-                  AND afoc.oto_id IS NOT NULL
-                GROUP BY o.name
-                ORDER BY Kassa DESC
-                """
-            )
-            rows_1 = cur.fetchall()
-
-            # Запрос 2: кассы по рег. организациям
-            cur.execute(
-                """
-                SELECT afoc.name, afoc.balance as Kassa
-                FROM algon_finance_online_cashbox afoc
-                WHERE (afoc.`type` = "reg" OR afoc.`type` = "manage_company")
-                  AND afoc.balance <> 0
-                ORDER BY Kassa DESC
-                """
-            )
-            rows_2 = cur.fetchall()
-
-        result = []
-        for row in rows_1 + rows_2:
-            name = (row.get("name") or "").strip()
-            balance = float(row.get("Kassa") or 0.0)
-            if balance != 0:
-                result.append({
-                    "name": name,
-                    "balance": balance,
-                    "type": "org" if row in rows_1 else "reg"
-                })
-
-        logging.info(f"Получено {len(result)} записей для кэша касс")
-        return result
-    except Exception as e:
-        logging.error(f"Ошибка при получении данных по кассам: {e}")
-        logging.error(traceback.format_exc())
-        return []
-    finally:
-        with contextlib.suppress(Exception):
-            if conn:
-                conn.close()
+    if not db.is_configured():
+        raise RuntimeError("Параметры подключения к БД неполные")
+
+    snapshot = await cashbox_repository.fetch()
+    logging.info("Получено %s записей для кэша касс", len(snapshot.rows))
+    return snapshot
+
+
+async def _persist_daily_cashboxes(snapshot, as_of):
+    await snapshot_db.save_cashboxes("daily", snapshot, as_of)
+
+
+# Снимок на 00:00: обновляется только по расписанию, используется в сводке и "Подробно кассы"
+daily_cashboxes = SWRCache("кассы на 00:00", fetch_cashboxes_data, on_update=_persist_daily_cashboxes)
+# Почти живые данные для "Актуальные кассы": не чаще одного запроса за CASHBOX_CACHE_TTL
+live_cashboxes = SWRCache("актуальные кассы", fetch_cashboxes_data, ttl=CASHBOX_CACHE_TTL)
 
 
 async def update_cashboxes_cache():
-    """Обновляет кэш данных по кассам"""
-    global cached_cashboxes_data, cached_cashboxes_timestamp
+    """Обновляет кэш данных по кассам. Ошибка загрузки пробрасывается — планировщик повторит запуск"""
+    snapshot = await daily_cashboxes.refresh(raise_errors=True)
+    # Свежий снимок годится и для "Актуальных касс" — экономим запрос
+    live_cashboxes.set(snapshot, daily_cashboxes.as_of)
+    logging.info("Пул БД: %s", db.stats())
 
-    async with cashboxes_cache_lock:
-        data = await fetch_cashboxes_data()
-        cached_cashboxes_data = data
-        cached_cashboxes_timestamp = datetime.now(pytz.timezone('Europe/Moscow'))
-        logging.info(f"Кэш касс обновлен в {cached_cashboxes_timestamp.strftime('%H:%M:%S')}")
 
+async def restore_cashboxes_cache():
+    """Поднимает снимок касс с диска без запроса к БД; устаревший обновляется в фоне"""
+    try:
+        snapshot, as_of = await snapshot_db.load_cashboxes("daily")
+    except Exception as e:
+        logging.error("Не удалось прочитать снимок касс с диска: %s", e)
+        snapshot, as_of = None, None
 
-async def get_cashboxes_from_cache():
-    """Возвращает данные по кассам из кэша с временем обновления"""
-    async with cashboxes_cache_lock:
-        return cached_cashboxes_data.copy(), cached_cashboxes_timestamp
+    # Пока читали диск, первая выписка могла уже загрузить кассы из БД — они свежее
+    if snapshot is not None and daily_cashboxes.value is None:
+        daily_cashboxes.set(snapshot, as_of)
+        logging.info("Кэш касс восстановлен с диска (на %s)", as_of.strftime('%H:%M %d.%m.%Y'))
 
+    # Снимок со вчерашнего дня (или его нет) — догружаем, не задерживая старт
+    if snapshot is None or as_of.date() != datetime.now(pytz.timezone('Europe/Moscow')).date():
+        daily_cashboxes.refresh_in_background()
+    _mark_ready("cashboxes")
 
-async def scheduled_cache_update():
-    """Фоновая задача для обновления кэша каждый день в 00:00 по Москве"""
-    moscow_tz = pytz.timezone('Europe/Moscow')
 
+async def follow_shared_cashboxes(interval=SHARED_SNAPSHOT_POLL_SECONDS):
+    """Режимы ingest и bot: снимок касс на 00:00 пишет процесс scheduler, здесь он подхватывается с диска"""
     while True:
         try:
-            now_moscow = datetime.now(moscow_tz)
-            target_time = time(0, 0, 0)  # 00:00:00
+            snapshot, as_of = await snapshot_db.load_cashboxes("daily")
+            if snapshot is not None and (daily_cashboxes.as_of is None or as_of > daily_cashboxes.as_of):
+                daily_cashboxes.set(snapshot, as_of)
+                logging.info("Снимок касс на %s подхвачен с диска", as_of.strftime('%H:%M %d.%m.%Y'))
+        except Exception as e:
+            logging.error("Не удалось прочитать снимок касс с диска: %s", e)
+        _mark_ready("cashboxes")
+        await asyncio.sleep(interval)
 
-            # Вычисляем время до следующего 00:00
-            target_datetime = datetime.combine(now_moscow.date(), target_time)
-            target_datetime = moscow_tz.localize(target_datetime)
 
-            # Если уже прошло 00:00 сегодня, планируем на завтра
-            if now_moscow >= target_datetime:
-                target_datetime += timedelta(days=1)
+async def prewarm_caches():
+    """Перед рабочим днём: пошлины и актуальные кассы загружаются до первого нажатия"""
+    if not db.is_configured():
+        return
+    await asyncio.gather(duty_report.refresh(raise_errors=True), live_cashboxes.refresh(raise_errors=True))
+
+
+async def flush_metrics(path):
+    await asyncio.get_running_loop().run_in_executor(None, metrics.write_textfile, path)
 
-            wait_seconds = (target_datetime - now_moscow).total_seconds()
 
-            logging.info(f"Следующее обновление кэша касс в {target_datetime.strftime('%H:%M:%S %d.%m.%Y')}")
-            await asyncio.sleep(wait_seconds)
+# ---------- Парсинг входящих сообщений ----------
+def parse_financial_message(text):
+    """Парсит строки вида: ^Название$12345.67$. Возвращает (строки, сумма)"""
+    logging.debug("Запуск parse_financial_message()")
+    logging.debug("Текст для парсинга: %.500s", text)
+    with metrics.PARSE_SECONDS.time():
+        entries, total = parse_statement(text)
+    metrics.PARSE_ROWS.observe(len(entries))
+    logging.debug("Спарсенные данные: %s", entries)
+    logging.debug("Общая сумма: %s", total)
+    return entries, total
+
 
-            # Выполняем обновление
-            await update_cashboxes_cache()
+# ---------- Обработчики ----------
+# Все callback_query идут через одну таблицу маршрутов (см. callbacks.py)
+router = callbacks.Router()
+dp.callback_query()(router.dispatch)
 
-            # Ждем 1 секунду перед началом следующего цикла
-            await asyncio.sleep(1)
 
+async def _get_summary(token):
+    """Снимок сводки по токену: из памяти, а после перезапуска — с диска"""
+    if not token:
+        return None
+    summary = summaries.get(token)
+    if summary is not None and SHARED_SUMMARIES:
+        try:
+            version = await snapshot_db.load_summary_version(token)
         except Exception as e:
-            logging.error(f"Ошибка в scheduled_cache_update: {e}")
-            logging.error(traceback.format_exc())
-            # В случае ошибки ждем 5 минут перед повторной попыткой
-            await asyncio.sleep(300)
+            logging.error("Не удалось проверить версию сводки %s: %s", token, e)
+            version = None
+        if version is not None and version != summary.get("version", 1):
+            summary = None
+    if summary is None:
+        try:
+            summary = await snapshot_db.load_summary(token)
+        except Exception as e:
+            logging.error("Не удалось прочитать сводку %s с диска: %s", token, e)
+            return None
+        if summary is not None:
+            summaries.put(token, summary)
+    return summary
 
 
-# ---------- Парсинг входящих сообщений ----------
-def parse_financial_message(text):
-    """Парсит строки вида: ^Название$12345.67$ и суммирует значения"""
-    global parsed_data
-    logging.debug("Запуск parse_financial_message()")
-    logging.debug(f"Текст для парсинга: {text[:500]}")
-    parsed_data = []
-    total = 0.0
-    pattern = re.compile(r"^\^(.+?)\$(\-?[\d\s.,]+)\$", re.MULTILINE)
+async def _persist_summary(token, summary):
+    try:
+        await snapshot_db.save_summary(token, summary)
+    except Exception as e:
+        logging.error("Не удалось сохранить сводку %s на диск: %s", token, e)
 
-    for match in pattern.finditer(text):
-        name = match.group(1).strip()
-        value = float(match.group(2).replace("\xa0", "").replace(" ", "").replace(",", "."))
-        parsed_data.append((name, value))
-        total += value
 
-    parsed_data.sort(key=lambda x: x[1], reverse=True)
-    logging.debug(f"Спарсенные данные: {parsed_data}")
-    logging.debug(f"Общая сумма: {total}")
-    return total
+def _build_summary_text(now, total):
+    """Текст сводки по текущему снимку касс на 00:00"""
+    return render.summary_text(
+        now, total,
+        snapshot=daily_cashboxes.value,
+        as_of=daily_cashboxes.as_of,
+        refreshing=daily_cashboxes.is_refreshing(),
+        stale=daily_cashboxes.last_error is not None,
+    )
 
 
-# ---------- Обработчики ----------
-@client.on(events.NewMessage)
+async def _show_view(callback, view):
+    """Показывает представление в сообщении с кнопкой и подтверждает нажатие.
+
+    Если в сообщении уже то же самое, edit_message_text не вызывается.
+    """
+    chat_id = callback.message.chat.id
+    message_id = callback.message.message_id
+    if not displayed.is_shown(chat_id, message_id, view):
+        try:
+            await bot.edit_message_text(
+                chat_id=chat_id,
+                message_id=message_id,
+                text=view.text,
+                reply_markup=view.markup,
+                parse_mode="HTML"
+            )
+        except TelegramBadRequest as e:
+            if "message is not modified" not in str(e):
+                raise
+        displayed.mark(chat_id, message_id, view)
+    if callback.id not in answered_early:
+        await callback.answer()
+
+
+# Нажатия, на которые уже ответили "Обновляю…": второй answer() Telegram отклонит
+answered_early = LRUStore(maxsize=1000)
+
+
+async def _answer_while_loading(callback):
+    """Сразу гасит часики на кнопке, пока ответ ждёт загрузки из БД"""
+    with contextlib.suppress(Exception):
+        await callback.answer("Обновляю…")
+    answered_early.put(callback.id, True)
+
+
+async def _alert(callback, text, back_data=None):
+    """Сообщает об ошибке по нажатию: всплывающим окном или, если на нажатие уже ответили
+    "Обновляю…" (второй answer() Telegram отклонит), текстом в самом сообщении с кнопкой повтора"""
+    with contextlib.suppress(Exception):
+        if callback.id in answered_early:
+            await _show_view(callback, render.error_view(text, callback.data, back_data))
+        else:
+            await callback.answer(text, show_alert=True)
+
+
+async def _edit_summaries_when_ready(refresh_task, sent, token, summary):
+    """Дожидается фонового обновления касс и правит уже отправленные сводки.
+
+    Правятся только сообщения, где всё ещё показана исходная сводка: если
+    пользователь успел открыть счета или кассы, его экран не подменяется.
+    """
+    with contextlib.suppress(Exception):
+        await refresh_task
+
+    text = _build_summary_text(summary["date"], summary["total"])
+    if text == summary["text"]:
+        return
+    original = render.summary_view(token, summary)
+    summary["text"] = text
+    summary["version"] = summary.get("version", 1) + 1
+    await _persist_summary(token, summary)
+
+    view = render.summary_view(token, summary)
+    unchanged = [m for m in sent if displayed.is_shown(m.chat.id, m.message_id, original)]
+    for message in await broadcaster.edit(bot, unchanged, view.text, view.markup):
+        displayed.mark(message.chat.id, message.message_id, view)
+
+
+@loop_watchdog.traced
 async def handler(event):
-    """Принимаем новые сообщения, считаем, отправляем сводку с кнопками."""
-    global last_summary_text
+    """Принимаем новые сообщения и ставим выписки в очередь приёма (см. process_statements)."""
     text = event.text
-    logging.debug(f"Новое сообщение в Telegram: {text[:500] if text else ''}")
+    logging.debug("Новое сообщение в Telegram: %.500s", text or '')
     if not text or "^" not in text or "$" not in text:
         return
 
-    try:
-        total = parse_financial_message(text)
-        total_str = f"{total:,.2f}".replace(",", " ").replace(".", ",")
+    # Разбор и рассылка идут в воркерах очереди; при переполнении Telethon ждёт здесь.
+    # Id исходного сообщения едут вместе с текстом: по ним сводку находят в логе
+    await ingest_queue.put((event.chat_id, event.id, text))
 
-        now = datetime.now().strftime("%d.%m.%Y")
 
-        # Вместо obrabotchik() используем данные из кэша касс
-        cached_data, cache_time = await get_cashboxes_from_cache()
+@loop_watchdog.traced
+async def process_statements(items):
+    """Строит и рассылает одну сводку по пачке выписок, пришедших в окне склейки.
 
-        # Вычисляем общую сумму из кэшированных данных
-        kassa = 0.0
-        for item in cached_data:
-            kassa += item["balance"]
+    items — кортежи (chat_id, message_id, text) из handler.
+    """
+    # Токен сводки служит и correlation id: с ним в лог попадут рассылка,
+    # фоновая правка и все нажатия кнопок этой сводки
+    token = new_token()
+    with logs.correlation(token):
+        logging.info("Сводка по сообщениям %s",
+                     ", ".join(f"{chat_id}/{message_id}" for chat_id, message_id, _ in items))
+        try:
+            # Одно и то же сообщение, пересланное дважды, не удваивает суммы
+            texts = list(dict.fromkeys(text for _, _, text in items))
+            entries, total = [], Decimal(0)
+            for text in texts:
+                text_entries, text_total = parse_financial_message(text)
+                entries.extend(text_entries)
+                total += text_total
+            logging.info("Выписок: %s, строк: %s, итог %s", len(texts), len(entries), total)
+
+            now = datetime.now().strftime("%d.%m.%Y")
+
+            # Сводка никогда не ждёт БД: пустой кэш обновляется в фоне, сообщение правится после
+            refresh_task = None
+            if daily_cashboxes.value is None:
+                refresh_task = daily_cashboxes.refresh_in_background()
+
+            # Снимок этой сводки: кнопки найдут его по токену, даже если придут новые выписки
+            summary = {
+                "text": _build_summary_text(now, total),
+                "entries": entries,
+                "total": total,
+                "date": now,
+                "version": 1,
+            }
+            summaries.put(token, summary)
+            # До рассылки: в раздельном режиме кнопки обслуживает другой процесс и читает снимок с диска
+            await _persist_summary(token, summary)
+            view = render.summary_view(token, summary)
+
+            logging.debug("Отправка сводки в %s чат(ов)", len(summary_chat_ids))
+            sent = await broadcaster.send(bot, summary_chat_ids, view.text, view.markup)
+            logging.info("Сводка отправлена в %s из %s чат(ов)", len(sent), len(summary_chat_ids))
+            for message in sent:
+                displayed.mark(message.chat.id, message.message_id, view)
+
+            if sent and refresh_task is not None:
+                asyncio.create_task(_edit_summaries_when_ready(refresh_task, sent, token, summary))
+        except Exception as e:
+            logging.error("Ошибка при обработке выписки: %s", e)
+            logging.error(traceback.format_exc())
+            with contextlib.suppress(Exception):
+                await bot.send_message(chat_id=target_chat_id, text=f"❌ Ошибка при обработке: {e}")
 
-        # Если кэш пустой (например, при первом запуске), используем старую функцию
-        if kassa == 0.0:
-            kassa = await obrabotchik()
-            cache_time_str = "(данные из БД в реальном времени)"
-        else:
-            # Форматируем время кэширования
-            time_str = cache_time.strftime("%H:%M %d.%m.%Y") if cache_time else "время неизвестно"
-            cache_time_str = f""
-
-        kassa_str = f"{kassa:,.2f}".replace(",", " ").replace(".", ",")
-        itog_sum = total + kassa
-        itog_str = f"{itog_sum:,.2f}".replace(",", " ").replace(".", ",")
-
-        last_summary_text = (
-            f"<b>\U0001F4C5 Баланс Экосмотр на {now}</b>\n\n"
-            f"\U0001F4B3 <b>1. Р/с:</b> {total_str} ₽\n"
-            f"\U0001F3E6 <b>2. Кассы Драйв:</b> {kassa_str} ₽ {cache_time_str}\n\n"
-            f"\U0001F9FE <b>Итого:</b> {itog_str} ₽"
-        )
-
-        # Добавляем кнопку для показа данных из кэша
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="\U0001F4E8 Подробно счета", callback_data="show_raw")],
-            [InlineKeyboardButton(text="\U0001F4C8 Подробно кассы", callback_data="show_cached_cashboxes")]
-        ])
-
-        logging.debug("Отправка сообщения в Telegram (основной и дополнительный чат)")
-        await bot.send_message(chat_id=target_chat_id, text=last_summary_text, reply_markup=keyboard)
-        if target_chat_id_D != target_chat_id:
-            await bot.send_message(chat_id=target_chat_id_D, text=last_summary_text, reply_markup=keyboard)
-
-        if target_chat_id_N != target_chat_id:
-            await bot.send_message(chat_id=target_chat_id_N, text=last_summary_text, reply_markup=keyboard)
-
-        if target_chat_id_F != target_chat_id:
-            await bot.send_message(chat_id=target_chat_id_F, text=last_summary_text, reply_markup=keyboard)
-            
-        if target_chat_id_FF != target_chat_id:
-            await bot.send_message(chat_id=target_chat_id_FF, text=last_summary_text, reply_markup=keyboard)
+
+# Выписки из Telethon → ограниченная очередь → пачки в окне INGEST_COALESCE_SECONDS → сводка
+ingest_queue = IngestQueue(process_statements)
+
+
+async def _resolve_peer_id(value):
+    try:
+        peer = int(value) if value.lstrip("-").isdigit() else value
+        return await client.get_peer_id(peer)
     except Exception as e:
-        logging.error(f"Ошибка в handler: {e}")
-        logging.error(traceback.format_exc())
-        with contextlib.suppress(Exception):
-            await bot.send_message(chat_id=target_chat_id, text=f"❌ Ошибка при обработке: {e}")
+        logging.error("Не удалось найти чат/пользователя %r: %s", value, e)
+        return None
+
+
+async def _resolve_peer_ids(values):
+    """Переводит ID/@username из настроек в ID чатов Telethon один раз при старте (все запросы сразу)"""
+    ids = await asyncio.gather(*(_resolve_peer_id(value) for value in values))
+    return [peer_id for peer_id in ids if peer_id is not None]
+
+
+# Через сколько секунд снова искать чаты/отправителей, которые не нашлись
+SOURCE_RETRY_SECONDS = 60
+_source_filter = None  # (чаты, отправители), с которыми сейчас подписан handler()
+
+
+async def register_message_handler():
+    """Подписывает handler() на новые сообщения только из разрешённых чатов и отправителей.
+
+    Фильтр применяется на уровне events.NewMessage, поэтому сообщения из
+    остальных диалогов отбрасываются Telethon до вызова handler(). Повторный
+    вызов ищет источники заново и переподписывает handler(), если список изменился.
+    Возвращает True, если найдены все настроенные чаты и отправители.
+    """
+    global _source_filter
+    chats, senders = await asyncio.gather(_resolve_peer_ids(SOURCE_CHATS), _resolve_peer_ids(SOURCE_SENDERS))
+    complete = len(chats) == len(SOURCE_CHATS) and len(senders) == len(SOURCE_SENDERS)
+    source_filter = (chats if SOURCE_CHATS else None, senders if SOURCE_SENDERS else None)
+    if source_filter == _source_filter:
+        return complete
+
+    chats, senders = source_filter
+    if chats is None and senders is None:
+        logging.warning("SOURCE_CHATS не задан: обрабатываются сообщения из всех диалогов")
+    else:
+        logging.info("Источники сообщений: чаты %s, отправители %s",
+                     'все' if chats is None else chats, 'все' if senders is None else senders)
+
+    client.remove_event_handler(handler)
+    client.add_event_handler(handler, events.NewMessage(chats=chats, from_users=senders))
+    _source_filter = source_filter
+    return complete
+
+
+async def _retry_sources():
+    """Пока не найдены все источники, ищет их заново: временная ошибка при старте не должна
+    навсегда отрезать чат"""
+    while True:
+        await asyncio.sleep(SOURCE_RETRY_SECONDS)
+        try:
+            if await register_message_handler():
+                logging.info("Все источники сообщений найдены")
+                return
+        except Exception as e:
+            logging.error("Не удалось обновить источники сообщений: %s", e)
 
 
-@dp.callback_query(lambda c: c.data == "show_details")
-async def handle_callback(callback: CallbackQuery):
-    """Кнопка: показать детализацию по кассам (берём из БД заново, чтобы не зависеть от кеша)."""
+@router.route(callbacks.LIVE)
+async def handle_callback(callback: CallbackQuery, payload):
+    """Кнопка: показать детализацию по кассам (живой кэш с коротким TTL вместо запроса на каждое нажатие)."""
     logging.debug("Обработка callback: show_details")
-    conn = None
     try:
-        params = _db_params()
-        if any(v in (None, "") for v in params.values()):
+        if not db.is_configured():
             await callback.answer("База недоступна после перезапуска. Отправьте новое сообщение для обновления.",
                                   show_alert=True)
             return
 
-        conn = pymysql.connect(**params, cursorclass=pymysql.cursors.DictCursor)
-        with conn.cursor() as cur:
-            cur.execute(
-                """
-                SELECT o.name, SUM(afoc.balance) as Kassa
-                FROM algon_finance_online_cashbox afoc
-                         INNER JOIN oto o ON o.id = afoc.oto_id
-                WHERE afoc.`type` <> "disabled"
-                  AND afoc.balance <> 0
-                  AND afoc.oto_id IS NOT NULL
-                GROUP BY o.name
-                ORDER BY Kassa DESC
-                """
-            )
-            rows_1 = cur.fetchall()
-
-            cur.execute(
-                """
-                SELECT afoc.name, afoc.balance as Kassa
-                FROM algon_finance_online_cashbox afoc
-                WHERE (afoc.`type` = "reg" OR afoc.`type` = "manage_company")
-                  AND afoc.balance <> 0
-                ORDER BY Kassa DESC
-                """
-            )
-            rows_2 = cur.fetchall()
+        # Отдаём снимок не старше CASHBOX_CACHE_TTL; устаревший обновится в фоне
+        if live_cashboxes.value is None:
+            await _answer_while_loading(callback)
+        snapshot = await live_cashboxes.get()
 
-        if not rows_1 and not rows_2:
-            await callback.answer("Нет данных для показа. Отправьте новое сообщение.", show_alert=True)
+        back = callbacks.pack(callbacks.BACK, payload.snapshot)
+        if snapshot is None and live_cashboxes.last_error is not None:
+            await _alert(callback, f"Не удалось загрузить кассы: {live_cashboxes.last_error}", back)
+            return
+        if snapshot is None or not snapshot.rows:
+            await _alert(callback, "Нет данных для показа. Отправьте новое сообщение.", back)
             return
 
-        lines = []
-        for row in rows_1 + rows_2:
-            name = (row.get("name") or "").strip()
-            balance = float(row.get("Kassa") or 0.0)
-            balance_str = f"{balance:,.2f}".replace(",", " ").replace(".", ",")
-            bullet = "▪️" if row in rows_1 else "▫️"
-            lines.append(f"{bullet} {name}\n{balance_str} ₽\n")
-
-        message = "\n".join(lines) or "Нет данных"
-
-        keyboard_buttons = [
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main")],
-            [InlineKeyboardButton(text="\U0001F4C8 Подробно кассы", callback_data="show_cached_cashboxes")]
-        ]
-        keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
-
-        await bot.edit_message_text(
-            chat_id=callback.message.chat.id,
-            message_id=callback.message.message_id,
-            text=message,
-            reply_markup=keyboard,
-            parse_mode="HTML"
-        )
-        await callback.answer()
+        view = render.live_cashboxes_view(payload.snapshot, snapshot, live_cashboxes.as_of, payload.page)
+        await _show_view(callback, view)
     except TelegramBadRequest as e:
-        logging.warning(f"TelegramBadRequest: {e}")
-        await callback.answer("Сообщение устарело. Отправьте новое, и я покажу актуальные данные.", show_alert=True)
+        logging.warning("TelegramBadRequest: %s", e)
+        await _alert(callback, "Сообщение устарело. Отправьте новое, и я покажу актуальные данные.")
     except Exception as e:
-        logging.error(f"Ошибка в handle_callback: {e}")
+        logging.error("Ошибка в handle_callback: %s", e)
         logging.error(traceback.format_exc())
-        with contextlib.suppress(Exception):
-            await callback.answer(f"Ошибка: {e}", show_alert=True)
-    finally:
-        with contextlib.suppress(Exception):
-            if conn:
-                conn.close()
+        await _alert(callback, f"Ошибка: {e}", callbacks.pack(callbacks.BACK, payload.snapshot))
 
 
-@dp.callback_query(lambda c: c.data == "show_cached_cashboxes")
-async def handle_show_cached_cashboxes(callback: CallbackQuery):
+@router.route(callbacks.DAILY)
+async def handle_show_cached_cashboxes(callback: CallbackQuery, payload):
     """Кнопка: показать данные по кассам из кэша (обновленного в 00:00)"""
     logging.debug("Обработка callback: show_cached_cashboxes")
 
     try:
-        # Получаем данные из кэша
-        cached_data, cache_time = await get_cashboxes_from_cache()
-
-        if not cached_data:
-            keyboard = InlineKeyboardMarkup(
-                inline_keyboard=[[InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main")]]
-            )
-
-            await bot.edit_message_text(
-                chat_id=callback.message.chat.id,
-                message_id=callback.message.message_id,
-                text="Данные по кассам на 00:00 еще не собраны или отсутствуют",
-                reply_markup=keyboard,
-                parse_mode="HTML"
-            )
-            await callback.answer()
-            return
-
-        # Формируем сообщение с данными из кэша
-        lines = []
-        total = 0.0
-
-        for item in cached_data:
-            name = item["name"]
-            balance = item["balance"]
-            balance_str = f"{balance:,.2f}".replace(",", " ").replace(".", ",")
-            bullet = "▪️" if item["type"] == "org" else "▫️"
-            lines.append(f"{bullet} {name}\n{balance_str} ₽\n")
-            total += balance
-
-        # Добавляем итоговую сумму
-        total_str = f"{total:,.2f}".replace(",", " ").replace(".", ",")
-
-        # Формируем время обновления
-        time_str = "время неизвестно"
-        if cache_time:
-            time_str = cache_time.strftime("%H:%M %d.%m.%Y")
-
-        message = (
-                f"<b>Данные по кассам (обновлено {time_str})</b>\n\n"
-                + "\n".join(lines)
-                + f"\n<b>Итого:</b> {total_str} ₽"
-        )
-
-        keyboard_buttons = [
-            [InlineKeyboardButton(text="🔄 Актуальные кассы", callback_data="show_details")],
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main")]
-        ]
-        keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
-
-        await bot.edit_message_text(
-            chat_id=callback.message.chat.id,
-            message_id=callback.message.message_id,
-            text=message,
-            reply_markup=keyboard,
-            parse_mode="HTML"
-        )
-        await callback.answer()
+        view = render.cached_cashboxes_view(payload.snapshot, daily_cashboxes.value, daily_cashboxes.as_of,
+                                            payload.page, warming=_cashboxes_warming())
+        await _show_view(callback, view)
     except TelegramBadRequest as e:
-        logging.warning(f"TelegramBadRequest: {e}")
+        logging.warning("TelegramBadRequest: %s", e)
         try:
             await callback.answer("Сообщение устарело. Отправьте новое сообщение.", show_alert=True)
         except Exception:
             pass
     except Exception as e:
-        logging.error(f"Ошибка в handle_show_cached_cashboxes: {e}")
+        logging.error("Ошибка в handle_show_cached_cashboxes: %s", e)
         logging.error(traceback.format_exc())
         with contextlib.suppress(Exception):
             await callback.answer(f"Ошибка: {e}", show_alert=True)
 
 
-@dp.callback_query(lambda c: c.data == "show_raw")
-async def handle_show_raw(callback: CallbackQuery):
-    """Кнопка: показать сырые счета из последнего распарсенного сообщения (кеш).
-    Если кеша нет (после рестарта), показываем текст "Данные устарели" прямо в сообщении.
+@router.route(callbacks.RAW)
+async def handle_show_raw(callback: CallbackQuery, payload):
+    """Кнопка: показать сырые счета из выписки, по которой построена именно эта сводка.
+    Если снимка нет (вытеснен или после рестарта), показываем текст "Данные устарели" прямо в сообщении.
     """
     logging.debug("Обработка callback: show_raw")
-    global parsed_data
     try:
-        keyboard_buttons = [
-            [InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_main")],
-            [InlineKeyboardButton(text="\U0001F4C8 Кассы", callback_data="show_cached_cashboxes")]
-        ]
-        keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
-
-        if not parsed_data:
-            await bot.edit_message_text(
-                chat_id=callback.message.chat.id,
-                message_id=callback.message.message_id,
-                text="Данные устарели",
-                reply_markup=keyboard,
-                parse_mode="HTML"
-            )
-            await callback.answer()
-            return
-
-        lines = []
-        for name, value in parsed_data:
-            value_str = f"{value:,.2f}".replace(",", " ").replace(".", ",")
-            lines.append(f"▫️ {html.escape(name)}\n{value_str} ₽\n")
-
-        message = "\n".join(lines) or "Данные устарели"
-        await bot.edit_message_text(
-            chat_id=callback.message.chat.id,
-            message_id=callback.message.message_id,
-            text=message,
-            reply_markup=keyboard,
-            parse_mode="HTML"
-        )
-        await callback.answer()
+        summary = await _get_summary(payload.snapshot)
+        await _show_view(callback, render.raw_accounts_view(payload.snapshot, summary, payload.page))
     except TelegramBadRequest as e:
-        logging.warning(f"TelegramBadRequest: {e}")
+        logging.warning("TelegramBadRequest: %s", e)
         try:
             await callback.answer("Сообщение устарело. Отправьте новое сообщение.", show_alert=True)
         except Exception:
             pass
     except Exception as e:
-        logging.error(f"Ошибка в handle_show_raw: {e}")
+        logging.error("Ошибка в handle_show_raw: %s", e)
         logging.error(traceback.format_exc())
         with contextlib.suppress(Exception):
             await callback.answer(f"Ошибка: {e}", show_alert=True)
 
 
-@dp.callback_query(lambda c: c.data == "back_to_main")
-async def handle_back(callback: CallbackQuery):
+@router.route(callbacks.BACK)
+async def handle_back(callback: CallbackQuery, payload):
     """Кнопка: вернуться к сводному сообщению. Если сводки нет (после рестарта) — показываем 'Данные устарели' вместо алерта."""
     logging.debug("Обработка callback: back_to_main")
-    global last_summary_text
     try:
-        keyboard = InlineKeyboardMarkup(
-            inline_keyboard=[
-                [InlineKeyboardButton(text="\U0001F4E8 Подробно счета", callback_data="show_raw")],
-                [InlineKeyboardButton(text="\U0001F4C8 Подробно кассы", callback_data="show_cached_cashboxes")]
-            ]
-        )
-
-        text = last_summary_text if last_summary_text else "Данные устарели"
-        await bot.edit_message_text(
-            chat_id=callback.message.chat.id,
-            message_id=callback.message.message_id,
-            text=text,
-            reply_markup=keyboard,
-            parse_mode="HTML"
-        )
-        await callback.answer()
+        summary = await _get_summary(payload.snapshot)
+        await _show_view(callback, render.summary_view(payload.snapshot, summary))
     except TelegramBadRequest as e:
-        logging.warning(f"TelegramBadRequest: {e}")
+        logging.warning("TelegramBadRequest: %s", e)
         with contextlib.suppress(Exception):
             await callback.answer("Сообщение устарело. Отправьте новое.", show_alert=True)
     except Exception as e:
-        logging.error(f"Ошибка в handle_back: {e}")
+        logging.error("Ошибка в handle_back: %s", e)
         logging.error(traceback.format_exc())
         with contextlib.suppress(Exception):
             await callback.answer(f"Ошибка: {e}", show_alert=True)
 
 
-def _format_taxes_table(rows):
-    """
-    Возвращает список текстовых 'страниц' с таблицей в <pre>, чтобы не превышать ~3500-3800 символов.
-    Колонки: Код региона | Получатель | Остаток
-    """
-    if not rows:
-        return ["Данных не найдено."]
-
-    headers = ["Код региона", "Получатель", "Остаток"]
-
-    str_rows = []
-    col_widths = [len(h) for h in headers]
-    for r in rows:
-        region_code = str(r.get("Код региона", "") or "")
-        recipient = str(r.get("Получатель", "") or "")
-        count = str(r.get("Остаток", "") or "0")
-
-        row = [region_code, recipient, count]
-        str_rows.append(row)
-        for i, cell in enumerate(row):
-            col_widths[i] = max(col_widths[i], len(cell))
-
-    def fmt_row(cells):
-        return "  ".join(cell.ljust(col_widths[i]) for i, cell in enumerate(cells))
-
-    header_line = fmt_row(headers)
-    sep_line = "-" * len(header_line)
-
-    pages = []
-    current = ["<b>Актуальные гос.пошлины по регионам</b>", "<pre>", header_line, sep_line]
-    current_len = sum(len(x) for x in current) + 50  # запас на теги
-
-    for row in str_rows:
-        line = fmt_row(row)
-        if current_len + len(line) + 7 > 3500:
-            current.append("</pre>")
-            pages.append("\n".join(current))
-            current = ["<b>Актуальные гос.пошлины по регионам (продолжение)</b>", "<pre>", header_line, sep_line]
-            current_len = sum(len(x) for x in current) + 50
-
-        current.append(line)
-        current_len += len(line) + 1
-
-    current.append("</pre>")
-    pages.append("\n".join(current))
-    return pages
-
-
 @dp.message(Command("start"))
 async def cmd_start(message):
     try:
@@ -633,160 +601,229 @@ async def cmd_start(message):
     )
 
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Проверить пошлины", callback_data="check_taxes:1")]  # ← Добавлено :1
+        [InlineKeyboardButton(text="Проверить пошлины", callback_data=callbacks.pack(callbacks.TAXES, page=1))]
     ])
 
     await bot.send_message(chat_id=message.chat.id, text=text, reply_markup=keyboard)
 
 
-@dp.callback_query(lambda c: c.data.startswith("check_taxes"))
-async def handle_check_taxes(callback: CallbackQuery):
-    """Обработка кнопки 'Проверить пошлины' с постраничной навигацией"""
-    conn = None
+async def fetch_duty_report():
+    """Загрузчик кэша пошлин: агрегация из БД и сразу все готовые страницы"""
+    if not db.is_configured():
+        raise RuntimeError("Параметры подключения к БД неполные")
 
-    # Извлекаем номер страницы из callback_data
-    data_parts = callback.data.split(":")
-    current_page = int(data_parts[1]) if len(data_parts) > 1 else 1
+    rows = await duty_repository.fetch()
 
-    try:
-        params = _db_params()
-        if any(v in (None, "") for v in params.values()):
-            await callback.answer("База недоступна. Проверьте настройки подключения.", show_alert=True)
-            return
+    # Данные не изменились — оставляем ту же версию и готовые страницы
+    previous = duty_report.value
+    if previous is not None and previous["rows"] == rows:
+        return previous
 
-        conn = pymysql.connect(**params, cursorclass=pymysql.cursors.DictCursor)
-        with conn.cursor() as cur:
-            cur.execute("""
-                        SELECT dpr.id as 'Id', dpr.region_code as 'Код региона', dpr.recipient_name as 'Получатель', IF(COUNT(t.upno) = 0, 0, COUNT(t.upno)) as 'Остаток'
-                        FROM duty_payment_requisites dpr
-                                 LEFT JOIN webto_user_region_list wurl ON wurl.code = dpr.region_code
-                                 LEFT JOIN tax t ON t.region_id = wurl.id AND t.active = 1
-                        GROUP BY dpr.id, dpr.region_code, dpr.recipient_name
-                        ORDER BY COUNT(t.upno) DESC, dpr.region_code
-                        """)
-            rows = cur.fetchall()
-
-        # Разбиваем на страницы
-        pages = _format_taxes_table(rows)
-        total_pages = len(pages)
-
-        if total_pages == 0:
-            await bot.edit_message_text(
-                chat_id=callback.message.chat.id,
-                message_id=callback.message.message_id,
-                text="Данных не найдено.",
-                parse_mode="HTML"
-            )
-            await callback.answer()
-            return
+    report = {"version": new_token(), "rows": rows, "pages": render.taxes_pages(rows)}
+    duty_versions.put(report["version"], report)
+    return report
 
-        # Ограничиваем номер страницы в допустимых пределах
-        current_page = max(1, min(current_page, total_pages))
-
-        # Создаем клавиатуру с навигацией
-        keyboard_buttons = []
-
-        # Кнопки навигации (предыдущая/следующая)
-        nav_buttons = []
-        if current_page > 1:
-            nav_buttons.append(InlineKeyboardButton(
-                text="⬅️ Назад",
-                callback_data=f"check_taxes:{current_page - 1}"
-            ))
-
-        nav_buttons.append(InlineKeyboardButton(
-            text=f"{current_page}/{total_pages}",
-            callback_data="ignore"
-        ))
-
-        if current_page < total_pages:
-            nav_buttons.append(InlineKeyboardButton(
-                text="Вперёд ➡️",
-                callback_data=f"check_taxes:{current_page + 1}"
-            ))
-
-        if nav_buttons:
-            keyboard_buttons.append(nav_buttons)
-
-        # Кнопка обновления
-        keyboard_buttons.append([
-            InlineKeyboardButton(
-                text="🔄 Обновить",
-                callback_data="check_taxes:1"
-            )
-        ])
 
-        keyboard = InlineKeyboardMarkup(inline_keyboard=keyboard_buttons)
+# Отчёт по пошлинам: навигация по страницам не ходит в БД, только "Обновить" или истёкший TTL.
+# Несколько прошлых версий держим, чтобы старое сообщение листало свой снимок
+duty_report = SWRCache("гос. пошлины", fetch_duty_report, ttl=DUTY_CACHE_TTL)
+duty_versions = LRUStore(maxsize=5)
 
-        # Отправляем/редактируем сообщение
-        await bot.edit_message_text(
-            chat_id=callback.message.chat.id,
-            message_id=callback.message.message_id,
-            text=pages[current_page - 1],
-            reply_markup=keyboard,
-            parse_mode="HTML"
-        )
 
-        await callback.answer()
+async def _show_taxes_page(callback, report, current_page):
+    """Показывает страницу уже готового отчёта"""
+    try:
+        if report is None:
+            error = duty_report.last_error
+            await _alert(callback, f"Не удалось получить данные: {error}" if error else
+                         "Не удалось получить данные. Попробуйте позже.")
+            return
+
+        # Ограничиваем номер страницы в допустимых пределах
+        current_page = max(1, min(current_page, len(report["pages"])))
+
+        await _show_view(callback, render.taxes_view(report, current_page))
 
     except TelegramBadRequest as e:
-        if "message is not modified" in str(e):
-            # Сообщение не изменилось, просто подтверждаем нажатие
-            await callback.answer()
-        else:
-            logging.warning(f"TelegramBadRequest: {e}")
-            try:
-                await callback.answer("Сообщение устарело. Нажмите ещё раз «Проверить пошлины».", show_alert=True)
-            except Exception:
-                pass
+        # "message is not modified" сюда не доходит — его гасит _show_view
+        logging.warning("TelegramBadRequest: %s", e)
+        await _alert(callback, "Сообщение устарело. Нажмите ещё раз «Проверить пошлины».")
     except Exception as e:
-        logging.error(f"Ошибка в handle_check_taxes: {e}")
+        logging.error("Ошибка в handle_check_taxes: %s", e)
         logging.error(traceback.format_exc())
-        with contextlib.suppress(Exception):
-            await callback.answer(f"Ошибка: {e}", show_alert=True)
-    finally:
-        with contextlib.suppress(Exception):
-            if conn:
-                conn.close()
+        await _alert(callback, f"Ошибка: {e}")
+
+
+@router.route(callbacks.TAXES)
+async def handle_check_taxes(callback: CallbackQuery, payload):
+    """Обработка кнопки 'Проверить пошлины' с постраничной навигацией.
+
+    Снимок в payload — версия отчёта. Страницы своей версии отдаются из
+    памяти; если версия вытеснена — берём текущий отчёт.
+    """
+    version = payload.snapshot
+
+    if not db.is_configured():
+        await callback.answer("База недоступна. Проверьте настройки подключения.", show_alert=True)
+        return
+
+    report = duty_versions.get(version) if version else None
+    if report is None:
+        if duty_report.value is None:
+            await _answer_while_loading(callback)
+        report = await duty_report.get()
+    await _show_taxes_page(callback, report, payload.page)
+
+
+@router.route(callbacks.REFRESH_TAXES)
+async def handle_refresh_taxes(callback: CallbackQuery, payload):
+    """Кнопка '🔄 Обновить': единственный путь, который принудительно перечитывает БД"""
+    if not db.is_configured():
+        await callback.answer("База недоступна. Проверьте настройки подключения.", show_alert=True)
+        return
+
+    # Одновременные нажатия "Обновить" ждут одну и ту же загрузку
+    await _answer_while_loading(callback)
+    report = await duty_report.refresh()
+    if duty_report.last_error is not None:
+        # Не выдаём старый отчёт за обновлённый; "Назад" вернёт к нему
+        back = callbacks.pack(callbacks.TAXES, report["version"], 1) if report is not None else None
+        await _alert(callback, f"Не удалось обновить данные: {duty_report.last_error}", back)
+        return
+    await _show_taxes_page(callback, report, 1)
 
 
-# Добавляем обработчик для игнорирования кнопки "ignore"
-@dp.callback_query(lambda c: c.data == "ignore")
-async def handle_ignore(callback: CallbackQuery):
+@router.route(callbacks.IGNORE)
+async def handle_ignore(callback: CallbackQuery, payload):
     """Обработка кнопки, которая ничего не делает (например, номер страницы)"""
     await callback.answer()
 
 
 @dp.error()
 async def on_error(update, error):
-    logging.error(f"Ошибка в обработчике: {error}\nUpdate: {update}")
+    logging.error("Ошибка в обработчике: %s\nUpdate: %s", error, update)
 
 
-async def main():
-    logging.debug("Запуск main()")
+@dp.startup()
+async def on_bot_startup():
+    """Polling или webhook запущены — бот принимает нажатия"""
+    _mark_ready("bot")
 
-    # Запускаем фоновую задачу для обновления кэша
-    cache_task = asyncio.create_task(scheduled_cache_update())
-
-    # Выполняем первоначальное обновление кэша
-    logging.info("Выполняем первоначальное обновление кэша касс...")
-    await update_cashboxes_cache()
 
+async def _run_telethon():
+    """Приём выписок; падение Telethon перезапускает только его"""
+    retry_task = None
     while True:
         try:
             await client.start()
-            await asyncio.gather(
-                dp.start_polling(bot, allowed_updates=["message", "callback_query"]),
-                client.run_until_disconnected()
-            )
+            # После каждого переподключения заново ищем источники, которые не нашлись раньше
+            complete = await register_message_handler()
+            if not complete and (retry_task is None or retry_task.done()):
+                logging.warning("Не все источники сообщений найдены, повтор через %s с", SOURCE_RETRY_SECONDS)
+                retry_task = asyncio.create_task(_retry_sources())
+            _mark_ready("telethon")
+            await client.run_until_disconnected()
         except Exception as e:
-            logging.error(f"Главный цикл упал: {e}")
+            logging.error("Telethon упал: %s", e)
             logging.error(traceback.format_exc())
             await asyncio.sleep(3)
 
 
+async def _run_bot_updates():
+    """Обновления бота: webhook поднимается один раз, polling перезапускается при падении"""
+    if webhook.enabled():
+        await webhook.start(dp, bot, ALLOWED_UPDATES)
+        await asyncio.Event().wait()
+
+    # Оставшийся от webhook-режима адрес мешает getUpdates
+    with contextlib.suppress(Exception):
+        await bot.delete_webhook()
+    while True:
+        try:
+            await dp.start_polling(bot, allowed_updates=ALLOWED_UPDATES)
+            return  # остановлен сигналом
+        except Exception as e:
+            logging.error("Polling упал: %s", e)
+            logging.error(traceback.format_exc())
+            await asyncio.sleep(3)
+
+
+def build_scheduler(role):
+    """Задачи по расписанию для роли. Снимок касс и чистку диска делает один процесс (all или scheduler),
+    прогрев — тот, кто отвечает на кнопки: кэши живут в его памяти"""
+    jobs = Scheduler(store=snapshot_db)
+    if role in ("all", "scheduler"):
+        # Прежнее поведение: после ошибки повтор через 5 минут
+        jobs.add("cashboxes", update_cashboxes_cache, CASHBOX_SCHEDULE, timeout=300, retry=300, catch_up=True)
+        jobs.add("snapshots", snapshot_db.prune, SNAPSHOT_PRUNE_SCHEDULE, timeout=120, jitter=600, catch_up=True)
+    if role in ("all", "bot"):
+        jobs.add("prewarm", prewarm_caches, PREWARM_SCHEDULE, timeout=300, jitter=120, retry=60)
+    if metrics.METRICS_TEXTFILE:
+        path = metrics.METRICS_TEXTFILE.replace("{role}", role)
+        jobs.add("metrics", lambda: flush_metrics(path), METRICS_FLUSH_SCHEDULE, timeout=10)
+    return jobs
+
+
+# all — всё в одном процессе; ingest, bot и scheduler запускаются отдельными процессами
+# и обмениваются снимками через общий SQLite (SNAPSHOT_DB_PATH)
+ROLES = ("all", "ingest", "bot", "scheduler")
+
+
+async def main(role="all"):
+    logging.debug("Запуск main(%s)", role)
+    # Импорт aiogram/Telethon и чтение настроек — отдельной точкой, чтобы было видно, на что уходит старт
+    metrics.STARTUP_SECONDS.set(monotonic() - PROCESS_STARTED, component="imports")
+    setup(role)
+    _startup_pending.update(ROLE_COMPONENTS[role])
+
+    # Общий пул соединений с БД создаётся один раз на весь процесс (соединения — при первом запросе)
+    db.init_pool()
+
+    # Сторож event loop: опоздания в метрики, стек зависшего обработчика в лог
+    asyncio.create_task(loop_watchdog.LoopWatchdog().run())
+
+    # /metrics на том же event loop (только если задан METRICS_PORT)
+    await metrics.start_server()
+
+    # Всё ниже стартует одновременно: подключение Telethon, polling/webhook и прогрев кэшей
+    # не ждут друг друга. Пока кэши греются, сводки и кнопки показывают "загружаются"
+    jobs = []
+    if role in ("all", "scheduler"):
+        # Кэш касс поднимаем с диска; запрос к БД (если нужен) идёт в фоне
+        jobs.append(restore_cashboxes_cache())
+    else:
+        jobs.append(follow_shared_cashboxes())
+    jobs.append(build_scheduler(role).run())
+
+    if role in ("all", "ingest"):
+        ingest_queue.start()
+        jobs.append(_run_telethon())
+
+    if role in ("all", "bot"):
+        if db.is_configured():
+            # Первое нажатие "Проверить пошлины" не ждёт тяжёлой агрегации
+            duty_report.refresh_in_background()
+        jobs.append(_run_bot_updates())
+
+    await asyncio.gather(*jobs)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Сводки по выпискам и кнопки бота")
+    parser.add_argument("role", nargs="?", default="all", choices=ROLES,
+                        help="ingest — Telethon и рассылка сводок, bot — кнопки, "
+                             "scheduler — обновление касс по расписанию, all — всё вместе")
+    return parser.parse_args(argv)
+
+
 if __name__ == "__main__":
+    # Уровень и формат (text/json) — из LOG_LEVEL и LOG_FORMAT
+    logs.setup_logging()
+    args = parse_args()
     try:
-        asyncio.run(main())
+        asyncio.run(main(args.role))
     except KeyboardInterrupt:
         logging.info("Остановлено пользователем")
+    finally:
+        db.shutdown()
+        snapshot_db.close()